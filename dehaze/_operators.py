@@ -0,0 +1,91 @@
+import numpy as np
+import scipy as sc
+import scipy.sparse.linalg
+
+from .dcp import box_filter
+
+class MattingLaplacianOperator(sc.sparse.linalg.LinearOperator):
+    """
+    matting Laplacian as a LinearOperator, L @ p is computed with box filters
+    over the window statistics (He et al., large kernel matting), so the cost
+    is O(N) whatever win_size is and the matrix is never built
+    """
+    def __init__(self, I:np.ndarray, consts:np.ndarray=None, eps=1e-7, win_size:int=1) -> None:
+        h, w, c = I.shape
+        super().__init__(dtype=np.result_type(I.dtype, np.float64), shape=(h * w, h * w))
+        # the window covariance cancels badly in float32
+        I = I.astype(self.dtype, copy=False)
+        self.I = I
+        self.ks = (win_size * 2 + 1, win_size * 2 + 1)
+        self.neb_size = self.ks[0] * self.ks[1]
+
+        # windows taken into account: fully inside the image and not constrained
+        valid = np.zeros((h, w), dtype=bool)
+        valid[win_size:h-win_size, win_size:w-win_size] = True
+        if consts is not None:
+            consts = sc.ndimage.binary_erosion(consts, structure=np.ones(self.ks))
+            valid &= ~consts.astype(bool)
+        self.valid = valid
+
+        self.mu = box_filter(I, self.ks)
+        cov = box_filter(I[..., :, np.newaxis] * I[..., np.newaxis, :], self.ks)
+        cov -= self.mu[..., :, np.newaxis] * self.mu[..., np.newaxis, :]
+        cov[~valid] = np.eye(c)
+        self.inv_cov = np.linalg.inv(cov + eps / self.neb_size * np.eye(c))
+        self.inv_cov[~valid] = 0
+
+        # number of windows containing each pixel, the diagonal of D
+        self.count = self._box_sum(valid.astype(self.dtype))
+
+    def _box_sum(self, x):
+        return box_filter(x, self.ks, mode="constant") * self.neb_size
+
+    def _matvec(self, p):
+        h, w, c = self.I.shape
+        p = np.reshape(p, (h, w))
+
+        mean_p = box_filter(p, self.ks)
+        mean_Ip = box_filter(self.I * p[..., np.newaxis], self.ks)
+        a = np.einsum("...ij,...j->...i", self.inv_cov, mean_Ip - self.mu * mean_p[..., np.newaxis])
+        b = mean_p - np.sum(a * self.mu, axis=-1)
+        b[~self.valid] = 0
+
+        res = self.count * p - np.sum(self._box_sum(a) * self.I, axis=-1) - self._box_sum(b)
+        return res.ravel()
+
+    def _rmatvec(self, p):
+        return self._matvec(p)
+
+    def diagonal(self) -> np.ndarray:
+        """
+        L_ii = n_i - sum_k (1 + (I_i - mu_k)^T inv_cov_k (I_i - mu_k)) / |w|
+        """
+        mu_inv = np.einsum("...ij,...j->...i", self.inv_cov, self.mu)
+        sum_inv = self._box_sum(self.inv_cov)
+        sum_mu_inv = self._box_sum(mu_inv)
+        sum_mu_inv_mu = self._box_sum(np.sum(mu_inv * self.mu, axis=-1))
+
+        quad = (
+            np.einsum("...ij,...i,...j->...", sum_inv, self.I, self.I)
+            - 2 * np.sum(sum_mu_inv * self.I, axis=-1)
+            + sum_mu_inv_mu
+        )
+        return (self.count - (self.count + quad) / self.neb_size).ravel()
+
+class _ShiftedOperator(sc.sparse.linalg.LinearOperator):
+    """
+    L + lam * U for a LinearOperator L that knows its diagonal
+    """
+    def __init__(self, L, lam) -> None:
+        super().__init__(dtype=L.dtype, shape=L.shape)
+        self.L = L
+        self.lam = lam
+
+    def _matvec(self, x):
+        return self.L.matvec(x).ravel() + self.lam * np.ravel(x)
+
+    def _rmatvec(self, x):
+        return self._matvec(x)
+
+    def diagonal(self) -> np.ndarray:
+        return self.L.diagonal() + self.lam
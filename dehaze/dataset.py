@@ -1,14 +1,107 @@
-import matplotlib.pyplot as plt
 import os
+import json
 from collections import OrderedDict, namedtuple
 import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-SOTS_DATA = namedtuple('SOTS_DATA', ['gt', 'hazy', 'path'])
+from .decoder import _to_float, _to_uint8, imread
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 2
+
+PACK_MAGIC = b"SOTSPACK"
+PACK_VERSION = 1
+PACK_ALIGN = 64
+
+# path is the gt file as before, name is the hazy stem (unique per variant),
+# A and beta come from the hazy filename, e.g. 0001_0.8_0.2.jpg
+SOTS_DATA = namedtuple(
+    'SOTS_DATA', ['gt', 'hazy', 'path', 'name', 'A', 'beta'],
+    defaults=(None, None, None)
+)
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'prefetched', 'decode_time', 'bytes', 'evictions'])
+
+class ImageCache(object):
+    """
+    LRU cache of decoded images keyed by path, bounded by max_bytes,
+    the arrays are stored read-only since every caller gets the same one
+    """
+    def __init__(self, max_bytes:int=512 << 20) -> None:
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.images:
+                self.images.move_to_end(key)
+                return self.images[key]
+        return None
+
+    def put(self, key, img):
+        img.setflags(write=False)
+        if img.nbytes > self.max_bytes:
+            return img
+        with self.lock:
+            if key in self.images:
+                return self.images[key]
+            self.images[key] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes:
+                _, old = self.images.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+        return img
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.images)
+
+def _image_shape(path):
+    """
+    (H, W) or (H, W, C) as imread returns it, read from the header only
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        w, h = img.size
+        c = len(img.getbands())
+    return [h, w] if c == 1 else [h, w, c]
 
 class TinySOTS(object):
-    def __init__(self, root:str) -> None:
+    def __init__(
+        self, root:str, dtype=None, manifest=True, gt_cache=16, cache_bytes=0, prefetch=0,
+        decoder=None, scale=1,
+    ) -> None:
+        """
+        every hazy file is one sample, several variants may share a gt (full SOTS layout),
+        manifest=True keeps <root>/manifest.json (names, sizes, mtimes and image shapes),
+        a directory is listed again only when its mtime changed, manifest can also be
+        the path of the file, manifest=False always lists the directories,
+        the last gt_cache decoded gt images are kept (read-only) for their other variants,
+        cache_bytes > 0 keeps every decoded image in an ImageCache of that size (read-only),
+        prefetch=k decodes the next k samples on background threads after each __getitem__,
+        decoder and scale go to decoder.imread (scale 2, 4, 8 for reduced previews, shapes
+        stays at full resolution), decode_times keeps the decode time of every path
+        """
         self.root = root
+        self.dtype = dtype
+        self.decoder = decoder
+        self.scale = scale
+        self.decode_times = {}
+        if manifest is True:
+            manifest = os.path.join(self.root, MANIFEST_NAME)
+        self.manifest = manifest or None
         self.gt_dir = os.path.join(self.root, "gt")
         # self.gt_list = os.listdir(self.gt_dir)
 
@@ -17,8 +110,21 @@ class TinySOTS(object):
 
         self.gt = OrderedDict()
         self.hazy = OrderedDict()
+        self.variants = OrderedDict()
+        self.params = {}
+        self.shapes = {}
         self.index = []
 
+        self.gt_cache = gt_cache
+        self._gt_cache = OrderedDict()
+
+        self.cache = ImageCache(cache_bytes) if cache_bytes else None
+        self.prefetch = prefetch
+        self._pool = ThreadPoolExecutor(max_workers=prefetch) if prefetch else None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._counts = {"hits": 0, "misses": 0, "prefetched": 0, "decode_time": 0.0}
+
         self._prepare()
 
     def _get_prefix(self, filename):
@@ -26,46 +132,295 @@ class TinySOTS(object):
         match = re.search(pattern, filename)
         return match.group(1)
 
+    def _get_params(self, stem):
+        """
+        (A, beta) of a hazy stem <prefix>_<A>_<beta>, (None, None) otherwise
+        """
+        match = re.fullmatch(r"\d{4}_(\d*\.?\d+)_(\d*\.?\d+)", stem)
+        if match is None:
+            return None, None
+        return float(match.group(1)), float(match.group(2))
+
+    def _scan(self, dirname, old=None):
+        """
+        {name: {"prefix", "size", "mtime", "shape"}} of a directory,
+        entries of old with the same size and mtime keep their shape
+        """
+        old = {} if old is None else old["files"]
+        files = {}
+        for name in os.listdir(dirname):
+            st = os.stat(os.path.join(dirname, name))
+            e = old.get(name)
+            if e is None or e["size"] != st.st_size or e["mtime"] != st.st_mtime_ns:
+                e = {
+                    "prefix": self._get_prefix(name),
+                    "size": st.st_size,
+                    "mtime": st.st_mtime_ns,
+                    "shape": _image_shape(os.path.join(dirname, name)),
+                }
+            files[name] = e
+        return {"mtime": os.stat(dirname).st_mtime_ns, "files": files}
+
+    def _load_manifest(self):
+        if self.manifest is None or not os.path.exists(self.manifest):
+            return None
+        try:
+            with open(self.manifest) as f:
+                m = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if m.get("version") != MANIFEST_VERSION:
+            return None
+        return m
+
+    def _save_manifest(self, m):
+        # a read-only dataset still works, it is only scanned every time
+        try:
+            tmp = self.manifest + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(m, f, indent=1)
+            os.replace(tmp, self.manifest)
+        except OSError:
+            pass
+
     def _prepare(self):
-        D1 = {}
-        for name in os.listdir(self.gt_dir):
-            pre = self._get_prefix(name)
-            D1[pre] = os.path.join(self.gt_dir, name)
-       
+        old = self._load_manifest()
+        m = {"version": MANIFEST_VERSION}
+        changed = old is None
+        for key, dirname in [("gt", self.gt_dir), ("hazy", self.hazy_dir)]:
+            d = None if old is None else old.get(key)
+            if d is None or d["mtime"] != os.stat(dirname).st_mtime_ns:
+                d = self._scan(dirname, d)
+                changed = True
+            m[key] = d
+
+        D1 = {e["prefix"]: os.path.join(self.gt_dir, name) for name, e in m["gt"]["files"].items()}
         D2 = {}
-        for name in os.listdir(self.hazy_dir):
-            pre = self._get_prefix(name)
-            D2[pre] = os.path.join(self.hazy_dir, name)
+        for name, e in m["hazy"]["files"].items():
+            stem, _ = os.path.splitext(name)
+            D2[stem] = os.path.join(self.hazy_dir, name)
+            self.shapes[stem] = tuple(e["shape"])
+            self.params[stem] = self._get_params(stem)
+            self.variants.setdefault(e["prefix"], []).append(stem)
 
-        if D1.keys() != D2.keys():
+        if D1.keys() != self.variants.keys():
             raise ValueError
-        
+        if changed and self.manifest is not None:
+            self._save_manifest(m)
+
         self.gt = OrderedDict(sorted(D1.items(), key=lambda s:s[0]))
         self.hazy = OrderedDict(sorted(D2.items(), key=lambda s:s[0]))
-        self.index = list(self.gt.keys())
+        self.variants = OrderedDict(sorted((k, sorted(v)) for k, v in self.variants.items()))
+        self.index = list(self.hazy.keys())
         return len(self.index)
 
+    def group_by_shape(self):
+        """
+        {hazy shape: [idx, ...]} from the manifest, e.g. to stack same-sized images
+        for dcp.dehaze_batch without decoding them first
+        """
+        groups = OrderedDict()
+        for i, k in enumerate(self.index):
+            groups.setdefault(self.shapes[k], []).append(i)
+        return groups
+
+    def _decode(self, path):
+        if self.cache is not None:
+            img = self.cache.get(path)
+            if img is not None:
+                with self._lock:
+                    self._counts["hits"] += 1
+                return img
+
+        tic = time.perf_counter()
+        img = _to_float(imread(path, self.decoder, self.scale), self.dtype)
+        elapsed = time.perf_counter() - tic
+        with self._lock:
+            self._counts["misses"] += 1
+            self._counts["decode_time"] += elapsed
+            self.decode_times[path] = elapsed
+
+        if self.cache is not None:
+            img = self.cache.put(path, img)
+        return img
+
+    def _read(self, path):
+        with self._lock:
+            future = self._pending.pop(path, None)
+        if future is not None:
+            with self._lock:
+                self._counts["prefetched"] += 1
+            return future.result()
+        return self._decode(path)
+
+    def _prefetch(self, idx):
+        """
+        decode the samples idx+1..idx+prefetch in the background, pending decodes
+        outside that window (random access, get_by_prefix) are cancelled or dropped
+        """
+        window = []
+        for i in range(idx + 1, min(idx + 1 + self.prefetch, len(self.index))):
+            k = self.index[i]
+            window.append(self.hazy[k])
+            prefix = self._get_prefix(k)
+            if prefix not in self._gt_cache:
+                window.append(self.gt[prefix])
+
+        with self._lock:
+            for path in [p for p in self._pending if p not in window]:
+                self._pending.pop(path).cancel()
+        for path in window:
+            if self.cache is not None and self.cache.get(path) is not None:
+                continue
+            with self._lock:
+                if path not in self._pending:
+                    self._pending[path] = self._pool.submit(self._decode, path)
+
+    def stats(self) -> CacheStats:
+        """
+        hits and misses of the image cache, decodes served by the prefetcher,
+        total decode time (s, foreground and background) and cached bytes
+        """
+        with self._lock:
+            c = dict(self._counts)
+        cached = 0 if self.cache is None else self.cache.nbytes
+        evictions = 0 if self.cache is None else self.cache.evictions
+        return CacheStats(c["hits"], c["misses"], c["prefetched"], c["decode_time"], cached, evictions)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+            self.prefetch = 0
+        self._pending.clear()
+
+    def _get_gt(self, prefix):
+        if prefix in self._gt_cache:
+            self._gt_cache.move_to_end(prefix)
+            return self._gt_cache[prefix]
+        gt = self._read(self.gt[prefix])
+        if self.gt_cache:
+            # shared by every variant, so nobody may write into it
+            gt.setflags(write=False)
+            self._gt_cache[prefix] = gt
+            while len(self._gt_cache) > self.gt_cache:
+                self._gt_cache.popitem(last=False)
+        return gt
+
+    def _load(self, k):
+        prefix = self._get_prefix(k)
+        gt = self._get_gt(prefix)
+        hazy = self._read(self.hazy[k])
+
+        return SOTS_DATA(gt, hazy, self.gt[prefix], k, *self.params[k])
+
     def __len__(self):
         return len(self.index)
 
     def __getitem__(self, idx):
-        k = self.index[idx]
-        gt = plt.imread(self.gt[k])
-        if gt.dtype == np.uint8:
-            gt = gt / 255
-        hazy = plt.imread(self.hazy[k])
-        if hazy.dtype == np.uint8:
-            hazy = hazy / 255
+        if idx < 0:
+            idx += len(self.index)
+        X = self._load(self.index[idx])
+        if self.prefetch:
+            self._prefetch(idx)
+        return X
+
+    def get_by_prefix(self, prefix):
+        """
+        prefix is a hazy stem (0001_0.8_0.2) or a 4-digit gt prefix (its first variant)
+        """
+        k = prefix
+        if k not in self.hazy:
+            k = self.variants[prefix][0]
+        return self._load(k)
+
+def pack_sots(root:str, out_path:str) -> int:
+    """
+    pack a TinySOTS folder into one file: magic, version and the offset of the index,
+    the raw uint8 planes (64-byte aligned, each gt once), then the json index of
+    offsets and shapes, returns the number of samples
+    """
+    data = TinySOTS(root)
+    index = {"version": PACK_VERSION, "root": root, "gt": {}, "samples": []}
 
-        return SOTS_DATA(gt, hazy, self.gt[k])
+    def write(f, img):
+        img = np.ascontiguousarray(_to_uint8(img))
+        f.write(b"\0" * (-f.tell() % PACK_ALIGN))
+        offset = f.tell()
+        f.write(img.tobytes())
+        return [offset, list(img.shape)]
+
+    with open(out_path, 'wb') as f:
+        f.write(PACK_MAGIC + np.array([PACK_VERSION, 0], dtype="<u8").tobytes())
+        for prefix, path in data.gt.items():
+            index["gt"][prefix] = [os.path.relpath(path, root)] + write(f, imread(path))
+        for k in data.index:
+            A, beta = data.params[k]
+            index["samples"].append({
+                "name": k,
+                "prefix": data._get_prefix(k),
+                "A": A,
+                "beta": beta,
+                "hazy": write(f, imread(data.hazy[k])),
+            })
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode())
+        f.seek(len(PACK_MAGIC))
+        f.write(np.array([PACK_VERSION, index_offset], dtype="<u8").tobytes())
+    return len(index["samples"])
+
+class PackedSOTS(object):
+    def __init__(self, path:str, dtype=None, raw=False, root=None) -> None:
+        """
+        TinySOTS read from a pack_sots file through np.memmap, nothing is decoded,
+        raw=True returns read-only uint8 views into the map (zero copy),
+        otherwise images are converted to [0, 1] as TinySOTS does (dtype),
+        SOTS_DATA.path is the gt file under root (default: the root that was packed)
+        """
+        self.path = path
+        self.dtype = dtype
+        self.raw = raw
+        self.buf = np.memmap(path, dtype=np.uint8, mode='r')
+
+        head = len(PACK_MAGIC)
+        if bytes(self.buf[:head]) != PACK_MAGIC:
+            raise ValueError(f"{path} is not a packed SOTS file")
+        version, index_offset = np.frombuffer(self.buf[head:head + 16], dtype="<u8")
+        if version != PACK_VERSION:
+            raise ValueError(f"unsupported pack version {version}")
+        meta = json.loads(bytes(self.buf[index_offset:]).decode())
+        self.root = meta.get("root", "") if root is None else root
+
+        self.gt = OrderedDict(sorted(meta["gt"].items(), key=lambda s:s[0]))
+        self.samples = OrderedDict((s["name"], s) for s in meta["samples"])
+        self.index = list(self.samples.keys())
+        self.variants = OrderedDict()
+        for k, s in self.samples.items():
+            self.variants.setdefault(s["prefix"], []).append(k)
+
+    def _view(self, offset, shape):
+        n = int(np.prod(shape))
+        img = self.buf[offset:offset + n].reshape(shape)
+        return img if self.raw else _to_float(np.asarray(img), self.dtype)
+
+    def _load(self, k):
+        s = self.samples[k]
+        name, *gt = self.gt[s["prefix"]]
+        return SOTS_DATA(
+            self._view(*gt), self._view(*s["hazy"]), os.path.join(self.root, name), k, s["A"], s["beta"]
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        return self._load(self.index[idx])
 
     def get_by_prefix(self, prefix):
+        """
+        prefix is a hazy stem (0001_0.8_0.2) or a 4-digit gt prefix (its first variant)
+        """
         k = prefix
-        gt = plt.imread(self.gt[k])
-        if gt.dtype == np.uint8:
-            gt = gt / 255
-        hazy = plt.imread(self.hazy[k])
-        if hazy.dtype == np.uint8:
-            hazy = hazy / 255
-
-        return SOTS_DATA(gt, hazy, self.gt[k])
+        if k not in self.samples:
+            k = self.variants[prefix][0]
+        return self._load(k)
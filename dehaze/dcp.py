@@ -1,9 +1,10 @@
 import numpy as np
 import scipy as sc
-from typing import List, Optional, Union, Tuple
+from typing import List, Optional, Sequence, Union, Tuple
 import time
-from skimage.transform import resize
-from collections import namedtuple
+import inspect
+import threading
+from collections import OrderedDict, namedtuple
 
 DehazeOutput = namedtuple(
     "DehazeOutput",
@@ -11,6 +12,23 @@ DehazeOutput = namedtuple(
 )
 # namedtuple._asdict()
 
+SolveInfo = namedtuple(
+    "SolveInfo",
+    ["iterations", "residual", "time", "converged"]
+)
+
+def resize(image, output_shape, **kwargs):
+    # skimage.transform pulls in most of scipy, only the fast and pyramid paths need it
+    from skimage.transform import resize as _resize
+    return _resize(image, output_shape, **kwargs)
+
+def __getattr__(name):
+    # the LinearOperator subclasses need scipy.sparse.linalg, defined on first use
+    if name in ("MattingLaplacianOperator", "_ShiftedOperator"):
+        from . import _operators
+        return getattr(_operators, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 def _rgb2gray(A):
     r, g, b = A[..., 0], A[..., 1], A[..., 2]
     return 0.2989 * r + 0.5870 * g + 0.1140 * b
@@ -26,11 +44,59 @@ def _expand_A_as_B(A, B, left=False):
             A = A[..., np.newaxis]
     return A
 
-def get_dark_channel(img: np.ndarray, patch_size: Tuple[int, int]=(15,15)) -> np.ndarray:
+def _default(func, name):
+    """
+    default of a parameter of func, so the fused paths follow the signatures
+    """
+    return inspect.signature(func).parameters[name].default
+
+def _min_filter1d_vhgw(x:np.ndarray, k:int, axis:int) -> np.ndarray:
+    """
+    van Herk/Gil-Werman erosion along one axis, 3 comparisons per pixel
+    whatever k is, border is handled as mode='nearest'
+    """
+    x = np.moveaxis(x, axis, -1)
+    n = x.shape[-1]
+    # same window placement as scipy.ndimage.minimum_filter1d with origin=0
+    left = k // 2
+    num_blocks = -(-(n + k - 1) // k)
+    right = num_blocks * k - n - left
+    pad = [(0, 0)] * (x.ndim - 1) + [(left, right)]
+    xp = np.pad(x, pad, mode='edge').reshape(x.shape[:-1] + (num_blocks, k))
+
+    g = np.minimum.accumulate(xp, axis=-1).reshape(x.shape[:-1] + (-1,))
+    h = np.minimum.accumulate(xp[..., ::-1], axis=-1)[..., ::-1].reshape(x.shape[:-1] + (-1,))
+
+    res = np.minimum(h[..., :n], g[..., k - 1:k - 1 + n])
+    return np.moveaxis(res, -1, axis)
+
+def min_filter(img:np.ndarray, size:Tuple[int, int]=(15,15), backend:str="scipy") -> np.ndarray:
+    """
+    window min, backend "scipy" or "vhgw" (van Herk/Gil-Werman), both keep the dtype
+    """
+    size = np.broadcast_to(size, (img.ndim,))
+    if backend == "scipy":
+        return sc.ndimage.minimum_filter(img, size, mode='nearest')
+    elif backend == "vhgw":
+        res = img
+        for axis, k in enumerate(size):
+            if k > 1:
+                res = _min_filter1d_vhgw(res, int(k), axis)
+        return res.copy() if res is img else res
+    else:
+        raise NotImplementedError(f"backend {backend} not NotImplemented")
+
+def get_dark_channel(img: np.ndarray, patch_size: Tuple[int, int]=(15,15), backend:str="scipy") -> np.ndarray:
     if len(img.shape) == 3 and img.shape[-1] == 3:
         img_min = np.min(img, axis=-1)
-    elif len(img.shape) == 2 or (len(img.shape) == 3 and img.shape[-1] == 1):
-        img_min = img.copy()
+    elif len(img.shape) == 2:
+        img_min = img
+    elif len(img.shape) == 3 and img.shape[-1] == 1:
+        img_min = img[..., 0]
+    elif len(img.shape) == 4 and img.shape[-1] == 3:
+        # (N, H, W, 3) stack, no window along the batch axis
+        img_min = np.min(img, axis=-1)
+        patch_size = (1,) + tuple(np.broadcast_to(patch_size, (2,)))
     else:
         raise NotImplementedError
     
@@ -45,42 +111,46 @@ def get_dark_channel(img: np.ndarray, patch_size: Tuple[int, int]=(15,15)) -> np
     # for i, j in np.ndindex(img_min.shape):
     #     dc[i, j, ...] = np.min(img_padding[i:i+patch_size, j:j+patch_size, ...])
     
-    return sc.ndimage.minimum_filter(img_min, patch_size, mode='nearest')
+    return min_filter(img_min, patch_size, backend=backend)
 
-def get_mask(dc, top_ratio:float=1e-3) -> Union[float, np.ndarray]:
+def get_top_indices(dc, top_ratio:float=1e-3) -> np.ndarray:
     """
-    average of the top-intensity pixels
+    flat indices of the top-intensity pixels of the dark channel,
+    argpartition is linear in the number of pixels
     """
     numpix = max(int(dc.shape[0] * dc.shape[1] * top_ratio), 1)
-    
-    dc_flatten = dc.flatten()
-    indices = np.argsort(dc_flatten)[-numpix:]
-    mask = np.full(dc_flatten.shape, False, dtype=bool)
+
+    dc_flatten = dc.ravel()
+    return np.argpartition(dc_flatten, dc_flatten.size - numpix)[-numpix:]
+
+def get_mask(dc, top_ratio:float=1e-3, indices:Optional[np.ndarray]=None) -> Union[float, np.ndarray]:
+    """
+    average of the top-intensity pixels
+    """
+    if indices is None:
+        indices = get_top_indices(dc, top_ratio)
+
+    mask = np.full(dc.size, False, dtype=bool)
     mask[indices] = True
     
     return np.reshape(mask, dc.shape)
 
 
-def get_atmos_light(im, dc, top_ratio:float=1e-3) -> Union[float, np.ndarray]:
+def get_atmos_light(im, dc, top_ratio:float=1e-3, indices:Optional[np.ndarray]=None) -> Union[float, np.ndarray]:
     """
     average of the top-intensity pixels
     """
-    numpix = max(int(dc.shape[0] * dc.shape[1] * top_ratio), 1)
-    
-    dc_flatten = dc.flatten()
-    indices = np.argsort(dc_flatten)[-numpix:]
-    mask = np.full_like(dc_flatten, False)
-    mask[indices] = True
+    if indices is None:
+        indices = get_top_indices(dc, top_ratio)
 
     if len(im.shape) == 3:
-        mask = np.reshape(mask, dc.shape)[:, :, np.newaxis]
+        pixels = np.reshape(im, (-1, im.shape[-1]))[indices]
     elif len(im.shape) == 2:
-        mask = np.reshape(mask, dc.shape)
+        pixels = np.ravel(im)[indices]
     else:
         raise NotImplementedError
     
-    res = mask * im
-    return np.sum(res, axis=(0,1)) / numpix
+    return np.sum(pixels, axis=0) / len(indices)
 
 def get_tilde_t(im, A, omega=0.95, **kwarg):
     # while len(A.shape) < len(im.shape):
@@ -88,49 +158,162 @@ def get_tilde_t(im, A, omega=0.95, **kwarg):
     A = _expand_A_as_B(A, im, left=True)
     return 1 - omega * get_dark_channel(im / A, **kwarg)
 
-def get_laplace_matting_matrix(I:np.ndarray, consts:np.ndarray=None, eps=1e-7, win_size:int=1):
+def _matting_window_indices(h, w, win_size, ii, jj):
+    ks = win_size * 2 + 1
+    indsM = np.arange(0, h * w).reshape(h, w)
+    return np.lib.stride_tricks.sliding_window_view(indsM, (ks, ks))[ii, jj].reshape(-1, ks * ks)
+
+def _matting_window_values(I, ii, jj, eps, win_size):
     """
-    The original version is offered by Levin matlab code
+    (len(ii), neb_size, neb_size) affinities of the windows centered at (ii + win_size, jj + win_size)
     """
+    c = I.shape[-1]
+    ks = win_size * 2 + 1
+    neb_size = ks ** 2
+
+    winI = np.lib.stride_tricks.sliding_window_view(I, (ks, ks), axis=(0, 1))[ii, jj]
+    # E[I I^T] - mu mu^T cancels badly, float32 images are handled in float64
+    winI = winI.reshape(-1, c, neb_size).transpose(0, 2, 1).astype(np.float64, copy=False)
+
+    win_mu = np.mean(winI, axis=1, keepdims=True)
+    win_var = np.linalg.inv(
+        winI.transpose(0, 2, 1) @ winI / neb_size
+        - win_mu.transpose(0, 2, 1) @ win_mu
+        + eps / neb_size * np.eye(c)
+    )
+    winI = winI - win_mu
+    return (1 + (winI @ win_var) @ winI.transpose(0, 2, 1)) / neb_size
+
+LaplacianPattern = namedtuple(
+    "LaplacianPattern",
+    ["indptr", "indices", "slots", "diag"]
+)
+
+class LaplacianPatternCache(object):
+    """
+    LRU cache of the CSR structure of the matting Laplacian, keyed by (h, w, win_size),
+    only the values are recomputed for images of an already seen size,
+    a size is cached from its second request on, the patterns are bounded by max_bytes
+    and one that would not fit is never built (get returns None)
+    """
+    def __init__(self, max_bytes:int=256 << 20, maxseen:int=64) -> None:
+        self.max_bytes = max_bytes
+        self.maxseen = maxseen
+        self.patterns = OrderedDict()
+        self.seen = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate_bytes(h, w, win_size) -> int:
+        # slots dominate: one int32 per entry of every window
+        neb_size = (win_size * 2 + 1) ** 2
+        n_win = max(h - 2 * win_size, 0) * max(w - 2 * win_size, 0)
+        return 4 * (n_win * neb_size ** 2 + 2 * h * w * neb_size)
+
+    def get(self, h, w, win_size) -> Optional[LaplacianPattern]:
+        key = (h, w, win_size)
+        with self.lock:
+            if key in self.patterns:
+                self.patterns.move_to_end(key)
+                return self.patterns[key]
+            if self.estimate_bytes(h, w, win_size) > self.max_bytes:
+                return None
+            if key not in self.seen:
+                self.seen[key] = True
+                while len(self.seen) > self.maxseen:
+                    self.seen.popitem(last=False)
+                return None
+
+        pattern = self._build(h, w, win_size)
+        nbytes = sum(x.nbytes for x in pattern)
+        with self.lock:
+            if key not in self.patterns and nbytes <= self.max_bytes:
+                self.patterns[key] = pattern
+                self.nbytes += nbytes
+                while self.nbytes > self.max_bytes:
+                    _, old = self.patterns.popitem(last=False)
+                    self.nbytes -= sum(x.nbytes for x in old)
+        return pattern
+
+    def clear(self):
+        with self.lock:
+            self.patterns.clear()
+            self.seen.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self.patterns)
+
+    @staticmethod
+    def _build(h, w, win_size) -> LaplacianPattern:
+        img_size = h * w
+        jj, ii = np.nonzero(np.ones((w - 2 * win_size, h - 2 * win_size), dtype=bool))
+        win_inds = _matting_window_indices(h, w, win_size, ii, jj)
+
+        neb_size = win_inds.shape[1]
+        row_inds = np.broadcast_to(win_inds[:, np.newaxis, :], (len(ii), neb_size, neb_size)).ravel()
+        col_inds = np.broadcast_to(win_inds[:, :, np.newaxis], (len(ii), neb_size, neb_size)).ravel()
+
+        # sorted row-major keys are exactly the CSR order
+        keys, slots = np.unique(row_inds * img_size + col_inds, return_inverse=True)
+        index_dtype = np.int32 if max(len(keys), img_size) < np.iinfo(np.int32).max else np.int64
+        rows = keys // img_size
+        indices = (keys % img_size).astype(index_dtype)
+        indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=img_size)))).astype(index_dtype)
+        diag = np.flatnonzero(rows == indices).astype(index_dtype)
+        return LaplacianPattern(indptr, indices, slots.astype(index_dtype), diag)
+
+_pattern_cache = LaplacianPatternCache()
+
+def get_laplace_matting_matrix(
+    I:np.ndarray, consts:np.ndarray=None, eps=1e-7, win_size:int=1,
+    cache:Union[bool, LaplacianPatternCache]=True, assembly:str="coo"
+):
+    """
+    The original version is offered by Levin matlab code,
+    every window is handled at once instead of one by one,
+    cache reuses the CSR structure of sizes seen before (LaplacianPatternCache),
+    assembly="lean" builds it with get_laplace_matting_matrix_lean
+    """
+    if assembly == "lean":
+        return get_laplace_matting_matrix_lean(I, consts=consts, eps=eps, win_size=win_size)
+    elif assembly != "coo":
+        raise NotImplementedError(f"assembly {assembly} not NotImplemented")
+
     h, w, c = I.shape
     img_size = h * w
-    neb_size = (win_size * 2 + 1) ** 2
+    ks = win_size * 2 + 1
+    if h < ks or w < ks:
+        return sc.sparse.csr_matrix((img_size, img_size))
 
     ## the verse of "mask"
     if consts is not None:
-        consts = sc.ndimage.binary_erosion(consts, structure=np.ones((win_size * 2 + 1, win_size * 2 + 1)))
-        tlen = np.sum(1 - consts[win_size:h-win_size, win_size:w-win_size]) * (neb_size ** 2)
+        consts = sc.ndimage.binary_erosion(consts, structure=np.ones((ks, ks)))
+        valid = ~consts[win_size:h-win_size, win_size:w-win_size].astype(bool)
     else:
-        tlen = (h-2*win_size) * (w-2*win_size) * neb_size ** 2
+        valid = np.ones((h - 2 * win_size, w - 2 * win_size), dtype=bool)
 
-    indsM = np.arange(0, img_size).reshape(h, w)
-    row_inds = np.zeros(tlen, dtype=int)
-    col_inds = np.zeros(tlen, dtype=int)
-    vals = np.zeros(tlen)
-    LEN = 0
+    # same visiting order as the loop of the matlab code: column by column
+    jj, ii = np.nonzero(valid.T)
+    tvals = _matting_window_values(I, ii, jj, eps, win_size)
 
-    for j in range(win_size, w - win_size):
-        for i in range(win_size, h - win_size):
-            if consts is not None and consts[i, j]:
-                continue
+    # the structure only depends on the size when every window is used
+    pattern = None
+    if cache is not False and consts is None:
+        pattern = (_pattern_cache if cache is True else cache).get(h, w, win_size)
+    if pattern is not None:
+        nnz = len(pattern.indices)
+        data = -np.bincount(pattern.slots, weights=tvals.ravel(), minlength=nnz)
+        data[pattern.diag] -= np.add.reduceat(data, pattern.indptr[:-1])
+        return sc.sparse.csr_matrix(
+            (data, pattern.indices.copy(), pattern.indptr.copy()), shape=(img_size, img_size)
+        )
 
-            win_inds = indsM[i - win_size:i + win_size + 1, j - win_size: j + win_size + 1].flatten()
-            winI = I[i - win_size: i + win_size + 1, j - win_size: j + win_size + 1].reshape(neb_size, c)
-            win_mu = np.mean(winI, axis=0).reshape(3, 1)
-            win_var = np.linalg.inv(winI.T @ winI / neb_size - (win_mu@win_mu.T) + eps / neb_size * np.eye(c))
-            winI = winI - np.tile(win_mu.T, (neb_size, 1))
-            tvals = (1 + (winI @ win_var) @ winI.T) / neb_size
-
-            row_inds[LEN:LEN + neb_size**2] = np.tile(win_inds, (neb_size, 1)).flatten()
-            col_inds[LEN:LEN + neb_size**2] = np.repeat(win_inds, neb_size).flatten()
-            vals[LEN:LEN + neb_size**2] = tvals.flatten()
-
-            LEN += neb_size**2   
-
-    vals = vals[:LEN]
-
-    row_inds = row_inds[:LEN]
-    col_inds = col_inds[:LEN]
+    win_inds = _matting_window_indices(h, w, win_size, ii, jj)
+    row_inds = np.broadcast_to(win_inds[:, np.newaxis, :], tvals.shape).flatten()
+    col_inds = np.broadcast_to(win_inds[:, :, np.newaxis], tvals.shape).flatten()
+    vals = tvals.flatten()
 
     A = sc.sparse.coo_matrix((vals, (row_inds, col_inds)), shape=(img_size, img_size))
     
@@ -140,17 +323,464 @@ def get_laplace_matting_matrix(I:np.ndarray, consts:np.ndarray=None, eps=1e-7, w
 
 
 
+AssemblyInfo = namedtuple(
+    "AssemblyInfo",
+    ["peak_bytes", "matrix_bytes", "nnz"]
+)
+
+def get_laplace_matting_matrix_lean(
+    I:np.ndarray, consts:np.ndarray=None, eps=1e-7, win_size:int=1,
+    dtype=np.float32, chunk_rows:int=64, return_info=False
+):
+    """
+    same matrix as get_laplace_matting_matrix, assembled straight into CSR
+    a band of window rows at a time, with int32 indices when possible and dtype values,
+    the peak of the buffers held by the builder is reported in AssemblyInfo
+    """
+    h, w, c = I.shape
+    img_size = h * w
+    ks = win_size * 2 + 1
+    neb_size = ks ** 2
+    if h < ks or w < ks:
+        L = sc.sparse.csr_matrix((img_size, img_size), dtype=dtype)
+        return (L, AssemblyInfo(0, 0, 0)) if return_info else L
+
+    if consts is not None:
+        consts = sc.ndimage.binary_erosion(consts, structure=np.ones((ks, ks)))
+
+    # every pixel p is linked to p + (dy, dx) with |dy|, |dx| <= 2 * win_size,
+    # offsets in row-major order give sorted column indices within a CSR row
+    sr = 2 * win_size
+    ss = 2 * sr + 1
+    dy, dx = np.divmod(np.arange(ss * ss), ss)
+    dy, dx = dy - sr, dx - sr
+    center = sr * ss + sr
+
+    nnz = int(np.sum((h - np.abs(dy)) * (w - np.abs(dx))))
+    index_dtype = np.int32 if max(nnz, img_size) < np.iinfo(np.int32).max else np.int64
+    data = np.empty(nnz, dtype=dtype)
+    indices = np.empty(nnz, dtype=index_dtype)
+    indptr = np.zeros(img_size + 1, dtype=index_dtype)
+    matrix_bytes = data.nbytes + indices.nbytes + indptr.nbytes
+    peak = matrix_bytes
+    pos = 0
+
+    def flush(band, y0):
+        nonlocal pos
+        y = np.arange(y0, y0 + band.shape[0])[:, np.newaxis, np.newaxis]
+        x = np.arange(w)[np.newaxis, :, np.newaxis]
+        inside = (y + dy >= 0) & (y + dy < h) & (x + dx >= 0) & (x + dx < w)
+        n = int(np.count_nonzero(inside))
+        data[pos:pos + n] = band[inside]
+        indices[pos:pos + n] = ((y + dy) * w + x + dx)[inside]
+        indptr[y0 * w + 1:(y0 + band.shape[0]) * w + 1] = pos + np.cumsum(np.count_nonzero(inside, axis=-1).ravel())
+        pos += n
+        return inside.nbytes + n * (data.itemsize + indices.itemsize)
+
+    # rows [c0 - win_size, c0 + win_size) still wait for the windows of the next band
+    pending = np.zeros((sr, w, ss * ss), dtype=dtype)
+    for c0 in range(win_size, h - win_size, chunk_rows):
+        c1 = min(c0 + chunk_rows, h - win_size)
+        rows = c1 - c0
+        ii, jj = np.nonzero(np.ones((rows, w - sr), dtype=bool))
+        tvals = _matting_window_values(I, ii + c0 - win_size, jj, eps, win_size)
+        tvals = tvals.reshape(rows, w - sr, neb_size, neb_size)
+        if consts is not None:
+            tvals[consts[c0:c1, win_size:w - win_size]] = 0
+
+        band = np.concatenate((pending, np.zeros((rows, w, ss * ss), dtype=dtype)))
+        for a in range(neb_size):
+            ay, ax = divmod(a, ks)
+            target = band[ay:ay + rows, ax:ax + w - sr]
+            target[..., center] += np.sum(tvals[:, :, a, :], axis=-1)
+            for b in range(neb_size):
+                by, bx = divmod(b, ks)
+                target[..., (by - ay + sr) * ss + (bx - ax + sr)] -= tvals[:, :, a, b]
+
+        peak = max(peak, matrix_bytes + band.nbytes + tvals.nbytes + flush(band[:rows], c0 - win_size))
+        pending = band[rows:].copy()
+        del band, tvals
+
+    peak = max(peak, matrix_bytes + pending.nbytes + flush(pending, h - sr))
+
+    L = sc.sparse.csr_matrix((data, indices, indptr), shape=(img_size, img_size))
+    if consts is not None:
+        L.eliminate_zeros()
+    if return_info:
+        return L, AssemblyInfo(peak, matrix_bytes, nnz)
+    return L
+
+def get_preconditioner(M, precond:Optional[str]=None):
+    """
+    preconditioner of the SPD system M for cg:
+    None, "jacobi", "ssor" (symmetric Gauss-Seidel) or "amg" (needs pyamg)
+    """
+    if precond is None:
+        return None
+    elif precond == "jacobi":
+        inv_diag = 1 / M.diagonal()
+        return sc.sparse.linalg.LinearOperator(M.shape, matvec=lambda x: inv_diag * x.ravel(), dtype=M.dtype)
+    elif not sc.sparse.issparse(M):
+        raise ValueError(f"precond {precond} needs an explicit matrix")
+    elif precond == "ssor":
+        # (D + L) D^-1 (D + U), symmetric unlike spilu, so cg stays valid
+        lower = sc.sparse.tril(M, format='csr')
+        upper = sc.sparse.triu(M, format='csr')
+        diag = M.diagonal()
+        def matvec(x):
+            y = sc.sparse.linalg.spsolve_triangular(lower, x.ravel(), lower=True)
+            return sc.sparse.linalg.spsolve_triangular(upper, diag * y, lower=False)
+        return sc.sparse.linalg.LinearOperator(M.shape, matvec=matvec, dtype=M.dtype)
+    elif precond == "amg":
+        try:
+            import pyamg
+        except ImportError as e:
+            raise ImportError("precond='amg' requires pyamg") from e
+        return pyamg.smoothed_aggregation_solver(M.tocsr()).aspreconditioner(cycle='V')
+    else:
+        raise NotImplementedError(f"precond {precond} not NotImplemented")
+
+def solve_transmission(
+    L, tilde_t, lam=1e-4, solver:str="cg", precond:Optional[str]=None,
+    rtol=1e-5, maxiter:Optional[int]=None, warm_start=True, x0:Optional[np.ndarray]=None,
+) -> Tuple[np.ndarray, SolveInfo]:
+    """
+    solve (L + lam * U) t = lam * tilde_t, solver "cg" or "direct",
+    cg starts from x0 if given, else from tilde_t when warm_start,
+    L is a sparse matrix or a MattingLaplacianOperator (cg only)
+    """
+    tic = time.perf_counter()
+    if sc.sparse.issparse(L):
+        M = (L + lam * sc.sparse.identity(L.shape[0], dtype=L.dtype)).tocsr()
+    else:
+        from ._operators import _ShiftedOperator
+        M = _ShiftedOperator(L, lam)
+    b = lam * tilde_t.ravel()
+
+    iterations = 0
+    if solver == "direct":
+        if not sc.sparse.issparse(M):
+            raise ValueError("solver direct needs an explicit matrix")
+        t = sc.sparse.linalg.spsolve(M.tocsc(), b)
+        converged = True
+    elif solver == "cg":
+        def callback(xk):
+            nonlocal iterations
+            iterations += 1
+
+        if x0 is not None:
+            x0 = x0.ravel()
+        elif warm_start:
+            x0 = tilde_t.ravel()
+        t, info = sc.sparse.linalg.cg(
+            M, b, x0=x0, rtol=rtol, maxiter=maxiter,
+            M=get_preconditioner(M, precond), callback=callback
+        )
+        converged = info == 0
+    else:
+        raise NotImplementedError(f"solver {solver} not NotImplemented")
+
+    residual = float(np.linalg.norm(b - M @ t) / np.linalg.norm(b))
+    toc = time.perf_counter()
+    return t.reshape(tilde_t.shape), SolveInfo(iterations, residual, toc - tic, bool(converged))
+
+PyramidInfo = namedtuple(
+    "PyramidInfo",
+    ["shapes", "times", "solve", "refine"]
+)
+
 def soft_matting(
-    I:np.ndarray, p, lam=1e-4, **kwargs
+    I:np.ndarray, p, lam=1e-4, solver:str="cg", precond:Optional[str]=None,
+    rtol=1e-5, maxiter:Optional[int]=None, warm_start=True, return_info=False,
+    matrix_free=False, x0:Optional[np.ndarray]=None, levels:int=0,
+    tile_size:Optional[int]=None, memory_budget:Optional[int]=None, **kwargs
 ):
-    L = get_laplace_matting_matrix(I=I, **kwargs)
+    """
+    matrix_free uses MattingLaplacianOperator instead of the explicit Laplacian,
+    which makes large win_size affordable,
+    levels > 0 goes through pyramid_soft_matting,
+    tile_size or memory_budget goes through tiled_soft_matting
+    """
+    if tile_size is not None or memory_budget is not None:
+        return tiled_soft_matting(
+            I, p, lam, tile_size=tile_size, memory_budget=memory_budget, solver=solver,
+            precond=precond, rtol=rtol, maxiter=maxiter, warm_start=warm_start,
+            return_info=return_info, matrix_free=matrix_free, levels=levels, **kwargs
+        )
+
+    if levels > 0:
+        if x0 is not None:
+            raise ValueError("x0 is not supported with levels > 0, the pyramid makes its own")
+        return pyramid_soft_matting(
+            I, p, lam, levels=levels, solver=solver, precond=precond, rtol=rtol, maxiter=maxiter,
+            warm_start=warm_start, return_info=return_info, matrix_free=matrix_free, **kwargs
+        )
+
+    if matrix_free:
+        from ._operators import MattingLaplacianOperator
+        L = MattingLaplacianOperator(I=I, **kwargs)
+    else:
+        L = get_laplace_matting_matrix(I=I, **kwargs)
     # t = sc.sparse.linalg.spsolve(L + lam * sc.sparse.diags([1] * L.shape[0], 0), lam * p.flatten())
-    t, info = sc.sparse.linalg.cg(L + lam * sc.sparse.diags([1] * L.shape[0], 0), lam * p.flatten())
-    return t.reshape(p.shape)
+    t, info = solve_transmission(
+        L, p, lam, solver=solver, precond=precond,
+        rtol=rtol, maxiter=maxiter, warm_start=warm_start, x0=x0
+    )
+    if return_info:
+        return t, info
+    return t
+
+def _guided_upsample(I, I_coarse, t_coarse, ks:Tuple[int, int]=(5,5), eps=1e-4):
+    """
+    linear coefficients of t_coarse on the coarse guide, upsampled and applied to I
+    """
+    if len(I.shape) == 3 and I.shape[-1] == 3:
+        I = _rgb2gray(I)
+        I_coarse = _rgb2gray(I_coarse)
+
+    a, b = _guided_coefficients(I_coarse, t_coarse, ks, eps)
+    mean_a = resize(box_filter(a, ks), I.shape)
+    mean_b = resize(box_filter(b, ks), I.shape)
+    return mean_a * I + mean_b
+
+def pyramid_soft_matting(
+    I:np.ndarray, p, lam=1e-4, levels:int=1, refine_iters:int=0,
+    up_ks:Tuple[int, int]=(5,5), up_eps=1e-4, maxiter:Optional[int]=None, return_info=False, **kwargs
+):
+    """
+    coarse-to-fine soft matting: solve on I halved levels times (maxiter caps that solve),
+    go back up with guided upsampling on each level, then refine_iters cg iterations at full size,
+    PyramidInfo.times is the time spent per level, coarsest first,
+    consts is halved with the image, a coarse pixel is constrained if any of its 2x2 block is
+    """
+    if "x0" in kwargs:
+        raise ValueError("x0 is not supported, the coarse solve starts from p")
+    consts = kwargs.pop("consts", None)
+
+    Is, ps, cs = [I], [p], [consts]
+    for _ in range(levels):
+        shape = (Is[-1].shape[0] // 2, Is[-1].shape[1] // 2)
+        Is.append(resize(Is[-1], shape))
+        ps.append(resize(ps[-1], shape))
+        if consts is not None:
+            c = np.asarray(cs[-1], dtype=bool)[:2 * shape[0], :2 * shape[1]]
+            cs.append(c.reshape(shape[0], 2, shape[1], 2).any(axis=(1, 3)))
+        else:
+            cs.append(None)
+
+    tic = time.perf_counter()
+    t, solve = soft_matting(Is[-1], ps[-1], lam, maxiter=maxiter, return_info=True, consts=cs[-1], **kwargs)
+    times = [time.perf_counter() - tic]
+
+    for l in range(levels - 1, -1, -1):
+        tic = time.perf_counter()
+        t = _guided_upsample(Is[l], Is[l + 1], t, up_ks, up_eps)
+        times.append(time.perf_counter() - tic)
 
-def get_t(L, tilde_t, lam=1e-4, ):
-    t = sc.sparse.linalg.spsolve(L + lam * sc.sparse.diags([1] * L.shape[0], 0), lam * tilde_t.flatten())
-    return t.reshape(tilde_t.shape)
+    refine = None
+    if refine_iters > 0:
+        tic = time.perf_counter()
+        t, refine = soft_matting(I, p, lam, x0=t, maxiter=refine_iters, return_info=True, consts=consts, **kwargs)
+        times[-1] += time.perf_counter() - tic
+
+    if return_info:
+        shapes = [x.shape for x in ps[::-1]]
+        return t, PyramidInfo(shapes, times, solve, refine)
+    return t
+
+TileInfo = namedtuple(
+    "TileInfo",
+    ["tile_size", "overlap", "tiles", "solve"]
+)
+
+def get_tile_size(memory_budget:int, win_size:int=1, overlap:int=16, assembly:str="coo") -> int:
+    """
+    side of the square tiles (overlap excluded) whose soft matting fits in memory_budget bytes,
+    rough upper bound of the bytes per pixel of the Laplacian, its copies and the cg vectors
+    """
+    if assembly == "lean":
+        bytes_per_pixel = (4 * win_size + 1) ** 2 * 8 * 3 + 64
+    else:
+        bytes_per_pixel = (2 * win_size + 1) ** 4 * 56 + 64
+    side = int(np.sqrt(memory_budget / bytes_per_pixel)) - 2 * overlap
+    if side < 2 * win_size + 1:
+        raise ValueError(f"memory_budget {memory_budget} is too small for a single tile")
+    return side
+
+def _feather(n, lo, hi, overlap):
+    """
+    1d blending weights of a tile spanning n pixels, ramping down over the
+    overlap on the sides that have a neighbour
+    """
+    wt = np.ones(n)
+    ramp = (np.arange(overlap) + 0.5) / overlap
+    if lo and overlap > 0:
+        wt[:overlap] = ramp
+    if hi and overlap > 0:
+        wt[n - overlap:] = ramp[::-1]
+    return wt
+
+def _soft_matting_tile(args):
+    I, p, lam, kwargs = args
+    return soft_matting(I, p, lam, return_info=True, **kwargs)
+
+def tiled_soft_matting(
+    I:np.ndarray, p, lam=1e-4, tile_size:Optional[int]=None, overlap:int=16,
+    memory_budget:Optional[int]=None, workers:int=1, return_info=False, **kwargs
+):
+    """
+    soft matting on overlapping tiles solved independently and feathered together,
+    tile_size is derived from memory_budget (bytes per tile) when not given,
+    workers > 1 solves the tiles in a process pool, consts is cropped to each tile
+    """
+    h, w = p.shape
+    if tile_size is None:
+        if memory_budget is None:
+            raise ValueError("tile_size or memory_budget is needed")
+        tile_size = get_tile_size(
+            memory_budget, kwargs.get("win_size", 1), overlap, kwargs.get("assembly", "coo")
+        )
+
+    tiles = []
+    for y0 in range(0, h, tile_size):
+        for x0 in range(0, w, tile_size):
+            y1, x1 = min(y0 + tile_size, h), min(x0 + tile_size, w)
+            tiles.append((max(y0 - overlap, 0), min(y1 + overlap, h), max(x0 - overlap, 0), min(x1 + overlap, w)))
+
+    consts = kwargs.pop("consts", None)
+    jobs = [
+        (I[y0:y1, x0:x1], p[y0:y1, x0:x1], lam,
+         kwargs if consts is None else dict(kwargs, consts=consts[y0:y1, x0:x1]))
+        for y0, y1, x0, x1 in tiles
+    ]
+    if workers > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_soft_matting_tile, jobs))
+    else:
+        results = [_soft_matting_tile(job) for job in jobs]
+
+    t = np.zeros((h, w))
+    weight = np.zeros((h, w))
+    for (y0, y1, x0, x1), (t_tile, _) in zip(tiles, results):
+        wt = np.outer(_feather(y1 - y0, y0 > 0, y1 < h, overlap), _feather(x1 - x0, x0 > 0, x1 < w, overlap))
+        t[y0:y1, x0:x1] += wt * t_tile
+        weight[y0:y1, x0:x1] += wt
+    t /= weight
+
+    if return_info:
+        return t, TileInfo(tile_size, overlap, tiles, [info for _, info in results])
+    return t
+
+def get_t(L, tilde_t, lam=1e-4, solver:str="direct", return_info=False, **kwargs):
+    t, info = solve_transmission(L, tilde_t, lam, solver=solver, **kwargs)
+    if return_info:
+        return t, info
+    return t
+
+class TransmissionSolver(object):
+    """
+    keeps the Laplacian L to solve (L + lam * U) t = lam * tilde_t for many lam,
+    method "krylov": one multi-shift cg run (Jegerlehner) shares its Krylov basis
+    between every lam of a sweep, so a sweep costs about one solve at the smallest lam,
+    method "direct": sparse LU factorizations kept per lam (LRU of max_factors)
+    """
+    def __init__(self, L, method:str="krylov", rtol=1e-5, maxiter:Optional[int]=None, max_factors:int=4) -> None:
+        if method not in ["krylov", "direct"]:
+            raise NotImplementedError(f"method {method} not NotImplemented")
+        self.L = L.tocsr() if sc.sparse.issparse(L) else L
+        self.method = method
+        self.rtol = rtol
+        self.maxiter = maxiter if maxiter is not None else 10 * L.shape[0]
+        self.max_factors = max_factors
+        self.factors = OrderedDict()
+
+    def _factor(self, lam):
+        if lam in self.factors:
+            self.factors.move_to_end(lam)
+            return self.factors[lam]
+        M = self.L + lam * sc.sparse.identity(self.L.shape[0], dtype=self.L.dtype)
+        self.factors[lam] = sc.sparse.linalg.splu(M.tocsc())
+        while len(self.factors) > self.max_factors:
+            self.factors.popitem(last=False)
+        return self.factors[lam]
+
+    def _multi_shift_cg(self, b, lams):
+        """
+        solve (L + lam * U) y = b for every lam with the matvecs of the smallest one
+        """
+        sigma = min(lams)
+        shifts = [lam - sigma for lam in lams]
+        n = len(lams)
+
+        r = b.copy()
+        p = r.copy()
+        rr = r @ r
+        norm_b = np.sqrt(rr)
+        xs = [np.zeros_like(b) for _ in range(n)]
+        ps = [r.copy() for _ in range(n)]
+        zeta_prev = np.ones(n)
+        zeta = np.ones(n)
+        alpha_prev, beta_prev = 1.0, 0.0
+        active = np.ones(n, dtype=bool)
+        iterations = np.zeros(n, dtype=int)
+
+        for it in range(1, self.maxiter + 1):
+            Ap = self.L @ p + sigma * p
+            alpha = rr / (p @ Ap)
+            zeta_next = np.ones(n)
+            for k in np.flatnonzero(active):
+                denom = alpha * beta_prev * (zeta_prev[k] - zeta[k]) + zeta_prev[k] * alpha_prev * (1 + shifts[k] * alpha)
+                zeta_next[k] = zeta[k] * zeta_prev[k] * alpha_prev / denom
+                xs[k] += (alpha * zeta_next[k] / zeta[k]) * ps[k]
+
+            r -= alpha * Ap
+            rr_next = r @ r
+            beta = rr_next / rr
+            for k in np.flatnonzero(active):
+                ps[k] *= beta * (zeta_next[k] / zeta[k]) ** 2
+                ps[k] += zeta_next[k] * r
+                zeta_prev[k], zeta[k] = zeta[k], zeta_next[k]
+                iterations[k] = it
+                # residual of shift k is zeta_k * r
+                if abs(zeta[k]) * np.sqrt(rr_next) <= self.rtol * norm_b:
+                    active[k] = False
+
+            p = r + beta * p
+            alpha_prev, beta_prev, rr = alpha, beta, rr_next
+            if not active.any():
+                break
+        return xs, iterations, ~active
+
+    def sweep(self, tilde_t, lams:Sequence[float], return_info=False):
+        """
+        t for every lam of lams, with a SolveInfo each when return_info
+        """
+        tic = time.perf_counter()
+        b = np.ravel(tilde_t).astype(np.float64)
+        if self.method == "krylov":
+            ys, iterations, converged = self._multi_shift_cg(b, lams)
+            ts = [lam * y for lam, y in zip(lams, ys)]
+        else:
+            ts = [self._factor(lam).solve(lam * b) for lam in lams]
+            iterations = [0] * len(lams)
+            converged = [True] * len(lams)
+        elapsed = time.perf_counter() - tic
+
+        res = [t.reshape(tilde_t.shape) for t in ts]
+        if not return_info:
+            return res
+        infos = []
+        for lam, t, it, ok in zip(lams, ts, iterations, converged):
+            residual = np.linalg.norm(lam * b - (self.L @ t + lam * t)) / np.linalg.norm(lam * b)
+            infos.append(SolveInfo(int(it), float(residual), elapsed, bool(ok)))
+        return res, infos
+
+    def solve(self, tilde_t, lam=1e-4, return_info=False):
+        res = self.sweep(tilde_t, [lam], return_info=return_info)
+        if return_info:
+            return res[0][0], res[1][0]
+        return res[0]
 
 def get_J(I, A, t, t0=0.1, clip=True):
     A = _expand_A_as_B(A, I, left=True)
@@ -165,29 +795,62 @@ def get_depth(t, beta=0.388):
     return  - np.log(t) / beta
 
 
-def guided_filter(I, p, ks:Tuple[int, int]=(41,41), eps=1e-3):
-    if len(I.shape) == 3 and I.shape[-1] == 3:
-        I = _rgb2gray(I)
+def box_filter(x:np.ndarray, ks:Tuple[int, int]=(41,41), mode:str="nearest") -> np.ndarray:
+    """
+    mean over a ks window, same as convolving with np.ones(ks) / prod(ks)
+    but with separable running sums, the cost does not depend on ks
+    """
+    ks = tuple(ks) + (1,) * (x.ndim - len(ks))
+    res = x
+    for axis, k in enumerate(ks):
+        if k == 1:
+            continue
+        # convolve flips the kernel, so an even window leans one pixel right
+        origin = -1 if k % 2 == 0 else 0
+        res = sc.ndimage.uniform_filter1d(res, k, axis=axis, mode=mode, origin=origin)
+    return res
 
-    filter_mean = np.ones(ks)
-    filter_mean /= np.sum(filter_mean)
-    
-    p = _expand_A_as_B(p, I)
-    filter_mean = _expand_A_as_B(filter_mean, I)
 
-    mean_I = sc.ndimage.convolve(I, filter_mean, mode="nearest")
-    mean_p = sc.ndimage.convolve(p, filter_mean, mode="nearest")
-    corr_Ip = sc.ndimage.convolve(I * p , filter_mean, mode="nearest")
-    corr_I = sc.ndimage.convolve(I * I , filter_mean, mode="nearest")
+def _guided_coefficients(I, p, ks:Tuple[int, int]=(41,41), eps=1e-3, batched=False):
+    """
+    a, b of the local linear model p = a * I + b,
+    I and p are centered on their global means first so that corr - mean * mean
+    does not cancel badly in float32, var_I is clamped at 0 for the same reason,
+    batched: I and p are stacks of images, ks must then start with 1
+    """
+    if batched:
+        # one mean per image, computed exactly as for a single image
+        cI = np.array([float(np.mean(x)) for x in I], dtype=I.dtype)[:, np.newaxis, np.newaxis]
+        cp = np.array([float(np.mean(x)) for x in p], dtype=p.dtype)[:, np.newaxis, np.newaxis]
+    else:
+        cI = float(np.mean(I))
+        cp = float(np.mean(p))
+    I = I - cI
+    p = p - cp
+
+    mean_I = box_filter(I, ks)
+    mean_p = box_filter(p, ks)
+    corr_Ip = box_filter(I * p, ks)
+    corr_I = box_filter(I * I, ks)
 
-    var_I = corr_I - mean_I * mean_I
+    var_I = np.maximum(corr_I - mean_I * mean_I, 0)
     cov_Ip = corr_Ip - mean_I * mean_p
 
     a = cov_Ip / (var_I + eps)
-    b = mean_p - a * mean_I
+    b = (mean_p + cp) - a * (mean_I + cI)
+    return a, b
+
+
+def guided_filter(I, p, ks:Tuple[int, int]=(41,41), eps=1e-3):
+    if len(I.shape) == 3 and I.shape[-1] == 3:
+        I = _rgb2gray(I)
+
+    p = _expand_A_as_B(p, I)
 
-    mean_a = sc.ndimage.convolve(a, filter_mean, mode="nearest")
-    mean_b = sc.ndimage.convolve(b, filter_mean, mode="nearest")
+    a, b = _guided_coefficients(I, p, ks, eps)
+
+    mean_a = box_filter(a, ks)
+    mean_b = box_filter(b, ks)
 
     res = mean_a * I + mean_b
 
@@ -211,25 +874,10 @@ def fast_guided_filter(I, p, ks:Tuple[int, int]=(41,41), eps=1e-3, s=4):
 
     ks = (2 * r0 // s + 1, 2 * r1 // s + 1)
 
-    filter_mean = np.ones(ks)
-    filter_mean /= np.sum(filter_mean)
-    
-    
-    filter_mean = _expand_A_as_B(filter_mean, I)
-
-    mean_I = sc.ndimage.convolve(I, filter_mean, mode="nearest")
-    mean_p = sc.ndimage.convolve(p, filter_mean, mode="nearest")
-    corr_Ip = sc.ndimage.convolve(I * p , filter_mean, mode="nearest")
-    corr_I = sc.ndimage.convolve(I * I , filter_mean, mode="nearest")
-
-    var_I = corr_I - mean_I * mean_I
-    cov_Ip = corr_Ip - mean_I * mean_p
+    a, b = _guided_coefficients(I, p, ks, eps)
 
-    a = cov_Ip / (var_I + eps)
-    b = mean_p - a * mean_I
-
-    mean_a = sc.ndimage.convolve(a, filter_mean, mode="nearest")
-    mean_b = sc.ndimage.convolve(b, filter_mean, mode="nearest")
+    mean_a = box_filter(a, ks)
+    mean_b = box_filter(b, ks)
 
     mean_a = resize(mean_a, (h, w))
     mean_b = resize(mean_b, (h, w))
@@ -238,32 +886,370 @@ def fast_guided_filter(I, p, ks:Tuple[int, int]=(41,41), eps=1e-3, s=4):
     return res
 
 
+def _run_in_bands(func, arrays, halo:int, threads:int, pool=None):
+    """
+    func on row bands of arrays (same height), each band extended by halo rows
+    on both sides and cropped back, the bands are stitched in order
+    """
+    h = arrays[0].shape[0]
+    bounds = np.linspace(0, h, min(threads, h) + 1).astype(int)
+
+    def job(k):
+        y0, y1 = bounds[k], bounds[k + 1]
+        a0, a1 = max(y0 - halo, 0), min(y1 + halo, h)
+        return func(*[x[a0:a1] for x in arrays])[y0 - a0:y1 - a0]
+
+    if pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            parts = list(pool.map(job, range(len(bounds) - 1)))
+    else:
+        parts = list(pool.map(job, range(len(bounds) - 1)))
+    return np.concatenate(parts)
+
+
+def _haze_stages(I, patch_size, top_ratio, need, banded=None):
+    """
+    dark channel, mask, atmospheric light and tilde_t, the ones not in need are None
+    (but the dark channel), banded(func, arrays, halo) runs the local ones
+    """
+    if banded is None:
+        banded = lambda func, arrays, halo: func(*arrays)
+    A = tilde_t = None
+
+    dc = banded(lambda x: get_dark_channel(x, patch_size), [I], int(np.max(patch_size)))
+    indices = get_top_indices(dc, top_ratio)
+    mask = get_mask(dc, indices=indices) if "mask" in need else None
+    if "A" in need or "tilde_t" in need:
+        A = get_atmos_light(I, dc, indices=indices)
+    if "tilde_t" in need:
+        # get_tilde_t uses the default patch of get_dark_channel
+        halo = int(np.max(_default(get_dark_channel, "patch_size")))
+        tilde_t = banded(lambda x: get_tilde_t(x, A), [I], halo)
+    return dc, mask, A, tilde_t
+
 def dehaze_image(
     I: np.ndarray, 
     method: Optional[str],
     patch_size: Tuple[int, int] = (15,15), 
     top_ratio=1e-3,
+    dtype=None,
+    outputs: Optional[Sequence[str]] = None,
+    threads: Optional[int] = None,
     **kwargs,
 ):
+    """
+    dtype (e.g. np.float32) casts I once and keeps every stage in that precision,
+    outputs (e.g. ["J"]) restricts the DehazeOutput fields that are computed,
+    the others are None and the stages only they need are skipped,
+    threads > 1 runs the local stages (dark channel, tilde_t, guided filter, J, D)
+    on row bands with a halo in a thread pool, soft and fast refinements stay whole
+    """
     if method is not None and method not in ["soft", "guided", "fast"]:
         raise NotImplementedError(f"method {method} not NotImplemented")
-    
+    if outputs is None:
+        outputs = DehazeOutput._fields
+    elif not set(outputs) <= set(DehazeOutput._fields):
+        raise ValueError(f"unknown outputs {set(outputs) - set(DehazeOutput._fields)}")
+    if dtype is not None:
+        I = I.astype(dtype, copy=False)
+
+    # every stage is needed by the ones after it
+    need = set(outputs)
+    if need & {"J", "D"}:
+        need.add("t")
+    if "t" in need:
+        need.add("tilde_t")
+    if "tilde_t" in need:
+        need.add("A")
+    t = None
+
+    pool = None
+    if threads is not None and threads > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = ThreadPoolExecutor(max_workers=threads)
+        banded = lambda func, arrays, halo: _run_in_bands(func, arrays, halo, threads, pool)
+    else:
+        banded = lambda func, arrays, halo: func(*arrays)
+
+    try:
+        dc, mask, A, tilde_t = _haze_stages(I, patch_size, top_ratio, need, banded)
+
+        if "t" in need:
+            if method is None or method == "soft":
+                t = soft_matting(I, p=tilde_t, **kwargs)
+            elif method == "guided":
+                # two box filters in a row
+                halo = 2 * int(np.max(kwargs.get("ks", _default(guided_filter, "ks"))))
+                t = banded(lambda x, p: guided_filter(x, p=p, **kwargs), [I, tilde_t], halo)
+            elif method == "fast":
+                t = fast_guided_filter(I, p=tilde_t,  **kwargs)
+            else:
+                raise NotImplementedError
+            if dtype is not None:
+                t = t.astype(dtype, copy=False)
+
+        J = banded(lambda x, t: get_J(x, A, t), [I, t], 0) if "J" in need else None
+        D = banded(get_depth, [t], 0) if "D" in need else None
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return DehazeOutput(
+        *[v if k in outputs else None for k, v in zip(DehazeOutput._fields, (I, dc, mask, A, tilde_t, t, J, D))]
+    )
+
+def dehaze_methods(
+    I: np.ndarray,
+    methods: dict,
+    patch_size: Tuple[int, int] = (15,15),
+    top_ratio=1e-3,
+    outputs: Optional[Sequence[str]] = None,
+) -> Tuple[dict, dict]:
+    """
+    dehaze_image for several refinement methods at once, e.g.
+    methods = {"soft": {"lam": 1e-4}, "guided": {"ks": (41, 41)}, "fast": {"s": 4}},
+    dc, A and tilde_t are computed once and shared,
+    returns {method: DehazeOutput} and the times {"shared": ..., method: ...}
+    """
+    for method in methods:
+        if method not in ["soft", "guided", "fast"]:
+            raise NotImplementedError(f"method {method} not NotImplemented")
+    outputs = DehazeOutput._fields if outputs is None else outputs
+
+    tic = time.perf_counter()
+    dc, mask, A, tilde_t = _haze_stages(I, patch_size, top_ratio, set(outputs) | {"A", "tilde_t"})
+    times = {"shared": time.perf_counter() - tic}
+
+    res = {}
+    for method, kwargs in methods.items():
+        tic = time.perf_counter()
+        if method == "soft":
+            t = soft_matting(I, p=tilde_t, **kwargs)
+        elif method == "guided":
+            t = guided_filter(I, p=tilde_t, **kwargs)
+        else:
+            t = fast_guided_filter(I, p=tilde_t, **kwargs)
+        J = get_J(I, A, t) if "J" in outputs else None
+        D = get_depth(t) if "D" in outputs else None
+        times[method] = time.perf_counter() - tic
+        res[method] = DehazeOutput(
+            *[v if k in outputs else None for k, v in zip(DehazeOutput._fields, (I, dc, mask, A, tilde_t, t, J, D))]
+        )
+    return res, times
+
+def dehaze_batch(
+    I: np.ndarray,
+    method: str = "guided",
+    patch_size: Tuple[int, int] = (15,15),
+    top_ratio=1e-3,
+    ks: Tuple[int, int] = (41,41),
+    eps=1e-3,
+    s=4,
+    omega=None,
+    t0=None,
+    beta=None,
+) -> DehazeOutput:
+    """
+    dehaze_image over a stack of same-sized images I of shape (N, H, W, 3),
+    the stages run on the whole stack along the batch axis, every field of the
+    DehazeOutput gets a leading N axis and matches the per-image results exactly,
+    only the "guided" and "fast" methods are supported,
+    omega, t0 and beta default to those of get_tilde_t, get_J and get_depth
+    """
+    omega = _default(get_tilde_t, "omega") if omega is None else omega
+    t0 = _default(get_J, "t0") if t0 is None else t0
+    beta = _default(get_depth, "beta") if beta is None else beta
+    if method not in ["guided", "fast"]:
+        raise NotImplementedError(f"method {method} not NotImplemented for batches")
+    if len(I.shape) != 4 or I.shape[-1] != 3:
+        raise ValueError(f"expected (N, H, W, 3) images, got {I.shape}")
+    n, h, w, _ = I.shape
+
     dc = get_dark_channel(I, patch_size)
-    mask = get_mask(dc, top_ratio)
-    A = get_atmos_light(I, dc, top_ratio)
-    tilde_t = get_tilde_t(I, A)
-
-    if method is None or method == "soft":
-        t = soft_matting(I, p=tilde_t, **kwargs)
-    elif method == "guided":
-        t = guided_filter(I, p=tilde_t,  **kwargs)
-    elif method == "fast":
-        t = fast_guided_filter(I, p=tilde_t,  **kwargs)
+    indices = np.stack([get_top_indices(x, top_ratio) for x in dc])
+    mask = np.zeros((n, h * w), dtype=bool)
+    np.put_along_axis(mask, indices, True, axis=1)
+    mask = mask.reshape(n, h, w)
+    A = np.stack([get_atmos_light(x, d, indices=k) for x, d, k in zip(I, dc, indices)])
+
+    A_ = A[:, np.newaxis, np.newaxis, :]
+    tilde_t = get_tilde_t(I, A_, omega=omega)
+
+    gray = _rgb2gray(I)
+    if method == "guided":
+        a, b = _guided_coefficients(gray, tilde_t, (1,) + tuple(ks), eps, batched=True)
+        t = box_filter(a, (1,) + tuple(ks)) * gray + box_filter(b, (1,) + tuple(ks))
     else:
-        raise NotImplementedError
-    
-    J = get_J(I, A, t)
-    D = get_depth(t)
+        shape = (h // s, w // s)
+        small = (1, 2 * ((ks[0] - 1) // 2) // s + 1, 2 * ((ks[1] - 1) // 2) // s + 1)
+        gray_s = np.stack([resize(x, shape) for x in gray])
+        p_s = np.stack([resize(x, shape) for x in tilde_t])
+        a, b = _guided_coefficients(gray_s, p_s, small, eps, batched=True)
+        mean_a = np.stack([resize(x, (h, w)) for x in box_filter(a, small)])
+        mean_b = np.stack([resize(x, (h, w)) for x in box_filter(b, small)])
+        t = mean_a * gray + mean_b
 
+    J = get_J(I, A_, t, t0=t0)
+    D = get_depth(t, beta=beta)
     return DehazeOutput(I, dc, mask, A, tilde_t, t, J, D)
 
+class DehazePlan(object):
+    """
+    Preallocated workspace to dehaze many images of the same shape with the same
+    parameters, same results as dehaze_image but every full-size buffer is
+    allocated once and reused. The DehazeOutput of run() is made of views of
+    these buffers, valid until the next run (copy=True returns copies).
+    A plan holds mutable state: use one plan per thread.
+    omega, t0 and beta default to those of get_tilde_t, get_J and get_depth.
+    """
+    def __init__(
+        self,
+        shape: Tuple[int, int],
+        method: Optional[str] = "guided",
+        patch_size: Tuple[int, int] = (15,15),
+        top_ratio=1e-3,
+        dtype=np.float64,
+        omega=None,
+        t0=None,
+        beta=None,
+        **kwargs,
+    ) -> None:
+        if method is not None and method not in ["soft", "guided", "fast"]:
+            raise NotImplementedError(f"method {method} not NotImplemented")
+        if method == "guided" and not set(kwargs) <= {"ks", "eps"}:
+            raise TypeError(f"unexpected arguments {set(kwargs) - {'ks', 'eps'}} for the guided plan")
+        h, w = shape[:2]
+        self.shape = (h, w)
+        self.method = method
+        self.patch_size = patch_size
+        self.top_ratio = top_ratio
+        self.dtype = np.dtype(dtype)
+        self.omega = _default(get_tilde_t, "omega") if omega is None else omega
+        self.tilde_t_patch = _default(get_dark_channel, "patch_size")
+        self.t0 = _default(get_J, "t0") if t0 is None else t0
+        self.beta = _default(get_depth, "beta") if beta is None else beta
+        self.kwargs = kwargs
+
+        if method == "guided":
+            self.ks = tuple(kwargs.get("ks", _default(guided_filter, "ks")))
+            self.eps = kwargs.get("eps", _default(guided_filter, "eps"))
+            # same window alignment as box_filter
+            self.origins = tuple(-1 if k % 2 == 0 else 0 for k in self.ks)
+
+        full = lambda *c: np.empty((h, w) + c, dtype=self.dtype)
+        self.dc = full()
+        self.mask = np.zeros((h, w), dtype=bool)
+        self.tilde_t = full()
+        self.t = full()
+        self.J = full(3)
+        self.D = full()
+
+        self._img = full(3)
+        self._min = full()
+        self._tmp = full()
+        if method == "guided":
+            self._gray = full()
+            self._Ic = full()
+            self._pc = full()
+            self._prod = full()
+            self._mean_I = full()
+            self._mean_p = full()
+            self._corr_Ip = full()
+            self._corr_I = full()
+
+    def _box(self, x, out):
+        (k0, k1), (o0, o1) = self.ks, self.origins
+        sc.ndimage.uniform_filter1d(x, k0, axis=0, mode="nearest", origin=o0, output=self._tmp)
+        sc.ndimage.uniform_filter1d(self._tmp, k1, axis=1, mode="nearest", origin=o1, output=out)
+        return out
+
+    def _dark_channel(self, img, patch_size, out):
+        np.min(img, axis=-1, out=self._min)
+        sc.ndimage.minimum_filter(self._min, patch_size, mode="nearest", output=out)
+        return out
+
+    def _guided(self, p):
+        I = self._img[..., 0]
+        gray, Ic, pc, prod = self._gray, self._Ic, self._pc, self._prod
+        mean_I, mean_p, corr_Ip, corr_I = self._mean_I, self._mean_p, self._corr_Ip, self._corr_I
+
+        # _rgb2gray, same order of operations
+        np.multiply(I, 0.2989, out=gray)
+        np.multiply(self._img[..., 1], 0.5870, out=prod)
+        gray += prod
+        np.multiply(self._img[..., 2], 0.1140, out=prod)
+        gray += prod
+
+        # _guided_coefficients
+        cI = float(np.mean(gray))
+        cp = float(np.mean(p))
+        np.subtract(gray, cI, out=Ic)
+        np.subtract(p, cp, out=pc)
+        self._box(Ic, mean_I)
+        self._box(pc, mean_p)
+        self._box(np.multiply(Ic, pc, out=prod), corr_Ip)
+        self._box(np.multiply(Ic, Ic, out=prod), corr_I)
+
+        var_I = corr_I
+        var_I -= np.multiply(mean_I, mean_I, out=prod)
+        np.maximum(var_I, 0, out=var_I)
+        cov_Ip = corr_Ip
+        cov_Ip -= np.multiply(mean_I, mean_p, out=prod)
+
+        a = cov_Ip
+        a /= np.add(var_I, self.eps, out=prod)
+        mean_I += cI
+        mean_p += cp
+        b = mean_p
+        b -= np.multiply(a, mean_I, out=prod)
+
+        mean_a = self._box(a, Ic)
+        mean_b = self._box(b, pc)
+        np.multiply(mean_a, gray, out=self.t)
+        self.t += mean_b
+        return self.t
+
+    def run(self, I: np.ndarray, copy=False) -> DehazeOutput:
+        if I.shape[:2] != self.shape:
+            raise ValueError(f"plan is for shape {self.shape}, got {I.shape[:2]}")
+        np.copyto(self._img, I, casting="same_kind")
+        img = self._img
+
+        dc = self._dark_channel(img, self.patch_size, self.dc)
+        indices = get_top_indices(dc, self.top_ratio)
+        self.mask.fill(False)
+        self.mask.flat[indices] = True
+        A = get_atmos_light(img, dc, indices=indices)
+
+        # get_tilde_t
+        np.divide(img, A, out=self.J)
+        tilde_t = self._dark_channel(self.J, self.tilde_t_patch, self.tilde_t)
+        tilde_t *= -self.omega
+        tilde_t += 1
+
+        if self.method == "guided":
+            t = self._guided(tilde_t)
+        elif self.method == "fast":
+            np.copyto(self.t, fast_guided_filter(img, p=tilde_t, **self.kwargs), casting="same_kind")
+            t = self.t
+        else:
+            np.copyto(self.t, soft_matting(img, p=tilde_t, **self.kwargs), casting="same_kind")
+            t = self.t
+
+        # get_J
+        J = self.J
+        np.clip(t, self.t0, 1, out=self._tmp)
+        np.subtract(img, A, out=J)
+        J /= self._tmp[..., np.newaxis]
+        J += A
+        np.clip(J, 0, 1, out=J)
+
+        # get_depth
+        np.log(t, out=self.D)
+        self.D /= -self.beta
+
+        res = DehazeOutput(img, dc, self.mask, A, tilde_t, t, J, self.D)
+        if copy:
+            res = DehazeOutput(*[np.copy(x) for x in res])
+        return res
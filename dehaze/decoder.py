@@ -0,0 +1,116 @@
+import time
+from collections import namedtuple
+from typing import Callable, Optional, Union
+
+import numpy as np
+
+DecodeInfo = namedtuple("DecodeInfo", ["path", "decoder", "shape", "scale", "time"])
+
+def _to_float(img, dtype=None):
+    """
+    uint8 and uint16 to [0, 1], float64 unless dtype; PNG used to come from plt.imread
+    as float32, with the uint8 decoders they are float64 too (same values)
+    """
+    if img.dtype in (np.uint8, np.uint16):
+        peak = np.iinfo(img.dtype).max
+        if dtype is None:
+            return img / peak
+        return img.astype(dtype) / np.asarray(peak, dtype=dtype)
+    if dtype is not None:
+        return img.astype(dtype, copy=False)
+    return img
+
+def _to_uint8(img):
+    if img.dtype == np.uint8:
+        return img
+    if img.dtype == np.uint16:
+        return np.round(img / 257).astype(np.uint8)
+    return np.round(np.clip(img, 0, 1) * 255).astype(np.uint8)
+
+def decode_pil(path: str, scale: int = 1) -> np.ndarray:
+    """
+    uint8 (H, W) or (H, W, C) straight from PIL, uint16 for 16-bit grayscale
+    (mode I;16 and the like, which PIL would clamp to 255 when converting),
+    scale > 1 decodes JPEG at 1/scale in the DCT (draft mode) and reduces
+    other formats by box averaging
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        wide = img.mode.startswith("I")
+        if wide:
+            img = img.convert("I")
+        if scale > 1:
+            w, h = img.size
+            if img.format == "JPEG":
+                img.draft(img.mode, (w // scale, h // scale))
+            # what draft did not reduce
+            factor = scale * img.size[0] // w
+            if factor > 1:
+                img = img.reduce(factor)
+        if wide:
+            return np.clip(np.asarray(img), 0, 65535).astype(np.uint16)
+        if img.mode not in ("L", "LA", "RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() or "transparency" in img.info else "RGB")
+        return np.asarray(img)
+
+def decode_matplotlib(path: str, scale: int = 1) -> np.ndarray:
+    """
+    the previous plt.imread path, converted to uint8, scale > 1 subsamples
+    """
+    import matplotlib.pyplot as plt
+
+    img = _to_uint8(plt.imread(path))
+    if scale > 1:
+        img = np.ascontiguousarray(img[::scale, ::scale])
+    return img
+
+DECODERS = {
+    "pil": decode_pil,
+    "matplotlib": decode_matplotlib,
+}
+
+def _default_decoder():
+    try:
+        import PIL.Image
+    except ImportError:
+        return "matplotlib"
+    return "pil"
+
+def register_decoder(name: str, func: Callable[..., np.ndarray]):
+    """
+    func(path, scale=1) -> uint8 array
+    """
+    DECODERS[name] = func
+
+def imread(
+    path: str,
+    decoder: Optional[Union[str, Callable[..., np.ndarray]]] = None,
+    scale: int = 1,
+    return_info=False,
+):
+    """
+    decode an image to uint8 (uint16 for 16-bit grayscale with pil),
+    decoder is a name of DECODERS or a callable (default pil, matplotlib
+    when PIL is missing), scale in (1, 2, 4, 8) is a reduced decode for preview runs
+    """
+    if scale not in (1, 2, 4, 8):
+        raise ValueError(f"scale must be 1, 2, 4 or 8, not {scale}")
+    if decoder is None:
+        decoder = _default_decoder()
+    func = DECODERS[decoder] if isinstance(decoder, str) else decoder
+
+    tic = time.perf_counter()
+    img = func(path, scale=scale)
+    elapsed = time.perf_counter() - tic
+
+    if return_info:
+        name = decoder if isinstance(decoder, str) else getattr(decoder, "__name__", str(decoder))
+        return img, DecodeInfo(path, name, img.shape, scale, elapsed)
+    return img
+
+def imread_float(path: str, dtype=None, **kwargs) -> np.ndarray:
+    """
+    imread scaled to [0, 1] (float64 unless dtype), what the scripts use
+    """
+    return _to_float(imread(path, **kwargs), dtype)
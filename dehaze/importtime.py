@@ -0,0 +1,90 @@
+"""
+import-time breakdown of the package, each measure runs in a fresh interpreter:
+
+    python -m dehaze.importtime                      # dehaze.dcp, dehaze.dataset, dehaze.runner
+    python -m dehaze.importtime dehaze.sweep -n 20
+    python -m dehaze.importtime --first guided --root data/tinySOTS
+"""
+import os
+import re
+import sys
+import argparse
+import subprocess
+from collections import namedtuple
+
+ImportTime = namedtuple("ImportTime", ["name", "self", "cumulative", "depth"])
+
+MODULES = ["dehaze.dcp", "dehaze.dataset", "dehaze.runner"]
+
+_LINE = re.compile(r"import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)")
+
+_FIRST = """
+import time
+tic = time.perf_counter()
+from dehaze import dataset, dcp
+X = dataset.TinySOTS({root!r})[0]
+dcp.dehaze_image(X.hazy, {method!r})
+print(time.perf_counter() - tic)
+"""
+
+def _run(args):
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join([root] + [p for p in [env.get("PYTHONPATH")] if p])
+    return subprocess.run([sys.executable] + args, capture_output=True, text=True, env=env, check=True)
+
+def import_times(modules=MODULES) -> list:
+    """
+    [ImportTime] (microseconds) of every module imported by `import modules`
+    """
+    res = _run(["-X", "importtime", "-c", "; ".join(f"import {m}" for m in modules)])
+    times = []
+    for line in res.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            us_self, us_cum, indent, name = match.groups()
+            times.append(ImportTime(name, int(us_self), int(us_cum), len(indent) // 2))
+    return times
+
+def by_package(times) -> dict:
+    """
+    self time summed per top-level package, largest first
+    """
+    res = {}
+    for t in times:
+        pkg = t.name.split(".")[0]
+        res[pkg] = res.get(pkg, 0) + t.self
+    return dict(sorted(res.items(), key=lambda s: -s[1]))
+
+def first_image(root, method="guided") -> float:
+    """
+    seconds from a cold interpreter to the first dehazed image of a TinySOTS folder
+    """
+    res = _run(["-c", _FIRST.format(root=os.path.abspath(root), method=method)])
+    return float(res.stdout.strip().splitlines()[-1])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dehaze.importtime")
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('-n', '--top', type=int, default=15)
+    parser.add_argument('--first', type=str, default=None, help="method, also time the first image")
+    parser.add_argument('--root', type=str, default="data/tinySOTS")
+    args = parser.parse_args(argv)
+
+    times = import_times(args.modules)
+    total = sum(t.self for t in times)
+    print(f"import {' '.join(args.modules)}: {total / 1e3:0.1f} ms, {len(times)} modules")
+
+    print("\nper package (self):")
+    for pkg, us in list(by_package(times).items())[:args.top]:
+        print(f"  {us / 1e3:8.1f} ms  {pkg}")
+
+    print("\nslowest modules (self / cumulative):")
+    for t in sorted(times, key=lambda s: -s.self)[:args.top]:
+        print(f"  {t.self / 1e3:8.1f} / {t.cumulative / 1e3:8.1f} ms  {t.name}")
+
+    if args.first:
+        print(f"\ncold start to the first {args.first} image: {first_image(args.root, args.first):0.3f} s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Optional, Sequence
+
+import numpy as np
+
+from . import dcp, dataset, constant
+
+RunStats = namedtuple(
+    "RunStats",
+    ["images", "elapsed", "throughput", "busy", "utilization", "results"]
+)
+
+_data = None
+
+def _init_worker(root, dtype):
+    global _data
+    _data = dataset.TinySOTS(root, dtype=dtype)
+
+def save_output(output_dir, prefix, path, params, res, elapsed):
+    """
+    same layout as the task scripts: <output_dir>/<prefix>/info.json and one jpg per field
+    """
+    import matplotlib.pyplot as plt
+
+    tmp_dir = os.path.join(output_dir, prefix)
+    os.makedirs(tmp_dir, exist_ok=True)
+    info = {
+        'params': params,
+        'path': path,
+        'prefix': prefix,
+        'A': [float(x) for x in np.ravel(res.A)],
+        'time': elapsed
+    }
+    with open(os.path.join(tmp_dir, "info.json"), 'w') as f:
+        json.dump(info, f, indent=4)
+
+    d = res._asdict()
+    d.pop('A')
+    for k, v in d.items():
+        if v is None:
+            continue
+        if len(v.shape) == 3 and v.shape[-1] == 3:
+            plt.imsave(os.path.join(tmp_dir, f"{k}.jpg"), v, **constant.rgb_mode)
+        else:
+            plt.imsave(os.path.join(tmp_dir, f"{k}.jpg"), v, **constant.gray_mode)
+    return info
+
+def _run_shard(shard, params, output_dir):
+    res = []
+    for i in shard:
+        tic = time.perf_counter()
+        X = _data[i]
+        prefix = X.name
+
+        tac = time.perf_counter()
+        out = dcp.dehaze_image(X.hazy, **params)
+        toc = time.perf_counter()
+
+        info = save_output(output_dir, prefix, X.path, params, out, toc - tac) if output_dir else None
+        res.append((i, os.getpid(), time.perf_counter() - tic, info))
+    return res
+
+def _run_shard_methods(shard, params, methods, output_dir):
+    """
+    every image is decoded once and dehazed with all the methods,
+    outputs go to <output_dir>/<method>/<prefix>
+    """
+    res = []
+    for i in shard:
+        tic = time.perf_counter()
+        X = _data[i]
+        prefix = X.name
+
+        outs, times = dcp.dehaze_methods(X.hazy, methods, **params)
+        info = {"prefix": prefix, "path": X.path, "time": times}
+        for method, out in outs.items():
+            if output_dir:
+                save_output(
+                    os.path.join(output_dir, method), prefix, X.path,
+                    dict(params, method=method, **methods[method]), out, times["shared"] + times[method]
+                )
+            info[method] = {
+                "A": [float(x) for x in np.ravel(out.A)],
+                "psnr": float(10 * np.log10(1 / np.mean((X.gt[..., :3] - out.J) ** 2))),
+            }
+        res.append((i, os.getpid(), time.perf_counter() - tic, info))
+    return res
+
+def run_sots(
+    root: str,
+    params: dict,
+    output_dir: Optional[str] = None,
+    workers: Optional[int] = None,
+    indices: Optional[Sequence[int]] = None,
+    shard_size: int = 1,
+    dtype=None,
+    progress=True,
+    methods: Optional[dict] = None,
+) -> RunStats:
+    """
+    dehaze a TinySOTS folder with a process pool, the index is cut into shards of
+    shard_size images, outputs are written as the task scripts do (when output_dir),
+    results come back in index order with the throughput (images/s) and
+    the busy time and utilization of each worker process,
+    methods ({method: kwargs}) runs every method on each image with shared dc, A and
+    tilde_t (dcp.dehaze_methods), params then only holds patch_size and top_ratio
+    """
+    if indices is None:
+        indices = range(len(dataset.TinySOTS(root)))
+    indices = list(indices)
+    shards = [indices[i:i + shard_size] for i in range(0, len(indices), shard_size)]
+
+    bar = None
+    if progress:
+        from tqdm import tqdm
+        bar = tqdm(total=len(indices))
+
+    tic = time.perf_counter()
+    done = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(root, dtype)) as pool:
+        if methods is None:
+            futures = [pool.submit(_run_shard, shard, params, output_dir) for shard in shards]
+        else:
+            futures = [pool.submit(_run_shard_methods, shard, params, methods, output_dir) for shard in shards]
+        for future in as_completed(futures):
+            res = future.result()
+            done.extend(res)
+            if bar is not None:
+                bar.update(len(res))
+    elapsed = time.perf_counter() - tic
+    if bar is not None:
+        bar.close()
+
+    done.sort(key=lambda s: s[0])
+    busy = {}
+    for _, pid, seconds, _ in done:
+        busy[pid] = busy.get(pid, 0) + seconds
+    utilization = {pid: seconds / elapsed for pid, seconds in busy.items()}
+
+    return RunStats(
+        len(done), elapsed, len(done) / elapsed, busy, utilization,
+        [info for *_, info in done]
+    )
@@ -0,0 +1,165 @@
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from itertools import product
+from typing import Optional, Sequence
+
+import numpy as np
+
+from . import dcp
+
+SweepPoint = namedtuple("SweepPoint", ["params", "output"])
+SweepResult = namedtuple("SweepResult", ["points", "counts", "time"])
+
+# parameters each refinement depends on and the (function, parameter) their default
+# comes from, eps is the guided filter regulariser and matting_eps the matting Laplacian one
+REFINE_PARAMS = {
+    "guided": {"ks": (dcp.guided_filter, "ks"), "eps": (dcp.guided_filter, "eps")},
+    "fast": {
+        "ks": (dcp.fast_guided_filter, "ks"),
+        "eps": (dcp.fast_guided_filter, "eps"),
+        "s": (dcp.fast_guided_filter, "s"),
+    },
+    "soft": {"matting_eps": (dcp.get_laplace_matting_matrix, "eps"), "lam": (dcp.soft_matting, "lam")},
+}
+
+# every default follows the signatures in dcp
+DEFAULTS = {
+    "method": "guided",
+    "patch_size": dcp._default(dcp.dehaze_image, "patch_size"),
+    "top_ratio": dcp._default(dcp.dehaze_image, "top_ratio"),
+    "omega": dcp._default(dcp.get_tilde_t, "omega"),
+    **{k: dcp._default(*src) for m in ["soft", "fast", "guided"] for k, src in REFINE_PARAMS[m].items()},
+}
+
+def expand_grid(grid: dict) -> list:
+    """
+    every combination of the values of grid, missing keys take DEFAULTS, the refinement
+    parameters of a point that are missing (or None) take the default of its method,
+    method None is soft as in dehaze_image
+    """
+    unknown = set(grid) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"unknown sweep parameters {unknown}")
+    bad = set(grid.get("method", [])) - set(REFINE_PARAMS) - {None}
+    if bad:
+        raise ValueError(f"unknown methods {bad}, expected one of {list(REFINE_PARAMS)}")
+    keys = list(grid)
+    points = []
+    for values in product(*[grid[k] for k in keys]):
+        params = dict(DEFAULTS)
+        params.update(zip(keys, values))
+        if params["method"] is None:
+            params["method"] = "soft"
+        for k, src in REFINE_PARAMS[params["method"]].items():
+            if k not in grid or params[k] is None:
+                params[k] = dcp._default(*src)
+        points.append(params)
+    return points
+
+def _refine_key(params):
+    return (params["method"],) + tuple(
+        tuple(v) if isinstance(v, (list, tuple)) else v
+        for v in (params[k] for k in REFINE_PARAMS[params["method"]])
+    )
+
+def sweep(
+    I: np.ndarray,
+    grid: dict,
+    workers: int = 1,
+    outputs: Optional[Sequence[str]] = None,
+) -> SweepResult:
+    """
+    dehaze I for every point of grid (dict of lists over method, patch_size, top_ratio,
+    omega, ks, eps, s, lam, matting_eps), each stage is computed once per distinct set of the
+    parameters it depends on: dc <- patch_size, A <- top_ratio, tilde_t <- omega,
+    t <- refinement parameters; soft points share one Laplacian per matting_eps and one
+    multi-shift solve for all their lam; refinements run on workers threads,
+    outputs as in dehaze_image, points come back in grid order
+    """
+    tic = time.perf_counter()
+    outputs = set(dcp.DehazeOutput._fields if outputs is None else outputs)
+    points = expand_grid(grid)
+    counts = {"dc": 0, "A": 0, "tilde_t": 0, "L": 0, "t": 0}
+
+    def patch_key(p):
+        return tuple(np.broadcast_to(p["patch_size"], (2,)))
+
+    dcs, As, tilde_ts = {}, {}, {}
+    for params in points:
+        k_dc = patch_key(params)
+        if k_dc not in dcs:
+            dc = dcp.get_dark_channel(I, k_dc)
+            dcs[k_dc] = dc
+            counts["dc"] += 1
+        k_A = k_dc + (params["top_ratio"],)
+        if k_A not in As:
+            indices = dcp.get_top_indices(dcs[k_dc], params["top_ratio"])
+            mask = dcp.get_mask(dcs[k_dc], indices=indices) if "mask" in outputs else None
+            As[k_A] = (dcp.get_atmos_light(I, dcs[k_dc], indices=indices), mask)
+            counts["A"] += 1
+        k_t = k_A + (params["omega"],)
+        if k_t not in tilde_ts:
+            tilde_ts[k_t] = dcp.get_tilde_t(I, As[k_A][0], omega=params["omega"])
+            counts["tilde_t"] += 1
+
+    # refinement jobs: one per (tilde_t, refinement) pair, soft ones grouped over lam
+    jobs = {}
+    for params in points:
+        k_t = patch_key(params) + (params["top_ratio"], params["omega"])
+        if params["method"] == "soft":
+            group = (k_t, "soft", params["matting_eps"])
+            jobs.setdefault(group, set()).add(params["lam"])
+        else:
+            jobs.setdefault((k_t,) + _refine_key(params), None)
+
+    Ls = {}
+    def laplacian(eps):
+        if eps not in Ls:
+            Ls[eps] = dcp.get_laplace_matting_matrix(I, eps=eps)
+            counts["L"] += 1
+        return Ls[eps]
+    for key in jobs:
+        if key[1] == "soft":
+            laplacian(key[2])
+
+    def run(key):
+        tilde_t = tilde_ts[key[0]]
+        method = key[1]
+        if method == "soft":
+            lams = sorted(jobs[key])
+            ts = dcp.TransmissionSolver(Ls[key[2]]).sweep(tilde_t, lams)
+            return {(key[0], "soft", key[2], lam): t for lam, t in zip(lams, ts)}
+        kwargs = dict(zip(REFINE_PARAMS[method], key[2:]))
+        if method == "guided":
+            t = dcp.guided_filter(I, p=tilde_t, **kwargs)
+        else:
+            t = dcp.fast_guided_filter(I, p=tilde_t, **kwargs)
+        return {key: t}
+
+    ts = {}
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for res in pool.map(run, list(jobs)):
+                ts.update(res)
+    else:
+        for key in jobs:
+            ts.update(run(key))
+    counts["t"] = len(ts)
+
+    res = []
+    for params in points:
+        k_dc = patch_key(params)
+        k_A = k_dc + (params["top_ratio"],)
+        k_t = k_A + (params["omega"],)
+        A, mask = As[k_A]
+        t = ts[(k_t,) + _refine_key(params)]
+        J = dcp.get_J(I, A, t) if "J" in outputs else None
+        D = dcp.get_depth(t) if "D" in outputs else None
+        output = dcp.DehazeOutput(*[
+            v if k in outputs else None
+            for k, v in zip(dcp.DehazeOutput._fields, (I, dcs[k_dc], mask, A, tilde_ts[k_t], t, J, D))
+        ])
+        res.append(SweepPoint(params, output))
+
+    return SweepResult(res, counts, time.perf_counter() - tic)
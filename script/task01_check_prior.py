@@ -3,7 +3,7 @@ Check the dark channel prior images under a folder
 """
 import sys
 sys.path.append("..")
-from dehaze import dcp
+from dehaze import dcp, decoder
 
 import os
 import numpy as np
@@ -18,12 +18,6 @@ import functools
 
 BINS = np.linspace(0, 1, 11)
 
-def __imread(path):
-    I = plt.imread(path)
-    if I.dtype == np.uint8:
-        I = I / 255
-    return I
-
 elapsed_time = 0
 
 def timer(func):
@@ -45,7 +39,7 @@ def main(input_dir, output_dir):
     # for filename in os.listdir(input_dir)
     for filename in tqdm(os.listdir(input_dir)):
         filepath = os.path.join(input_dir, filename)
-        I = __imread(filepath)
+        I = decoder.imread_float(filepath)
         dc = dcp.get_dark_channel(I, patch_size=(15, 15))
         hist, _ = np.histogram(dc.ravel(), bins=BINS)
     res += hist
@@ -42,7 +42,8 @@ parser.add_argument(
 parser.add_argument(
     '--lam',
     type=float,
-    default=1e-4
+    nargs='+',
+    default=[1e-4]
 )
 
 args = parser.parse_args()
@@ -66,9 +67,11 @@ for i in tqdm(range(len(subset))):
     dc = dcp.get_dark_channel(I)
     A = dcp.get_atmos_light(I, dc)
     tilde_t = dcp.get_tilde_t(I, A)
-    t = dcp.soft_matting(I, p=tilde_t, lam=lam)
-    
-    filepath = os.path.join(output_root, f"{prefix}_t_{lam}.png")
+    # one Laplacian and one multi-shift cg run for every lam
+    L = dcp.get_laplace_matting_matrix(I)
+    ts = dcp.TransmissionSolver(L).sweep(tilde_t, lam)
 
-    plt.imsave(filepath, t, **constant.gray_mode)
+    for l, t in zip(lam, ts):
+        filepath = os.path.join(output_root, f"{prefix}_t_{l}.png")
+        plt.imsave(filepath, t, **constant.gray_mode)
 
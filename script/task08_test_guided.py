@@ -3,6 +3,7 @@ sys.path.append("..")
 from dehaze import (
     dcp,
     constant,
+    sweep,
 )
 from dehaze.dataset import TinySOTS
 import matplotlib.pyplot as plt
@@ -42,13 +43,21 @@ parser.add_argument(
 parser.add_argument(
     '--ks',
     type=int,
-    default=5
+    nargs='+',
+    default=[5]
 )
 
 parser.add_argument(
     '--epsilon',
     type=float,
-    default=1e-2
+    nargs='+',
+    default=[1e-2]
+)
+
+parser.add_argument(
+    '-w', '--workers',
+    type=int,
+    default=1
 )
 
 args = parser.parse_args()
@@ -62,17 +71,19 @@ if not os.path.exists(output_root):
 subset = json.load(open(args.subset, 'r'))['prefix']
 data = TinySOTS(root=input_root)
 p = (args.patch, args.patch)
-ks = (args.ks, args.ks)
-epsilon = args.epsilon
+grid = {
+    "method": ["guided"],
+    "ks": [(k, k) for k in args.ks],
+    "eps": args.epsilon,
+}
 
 for i in tqdm(range(len(subset))):
     prefix = subset[i]
     gt, hazy, *_ = data.get_by_prefix(prefix=prefix)
     I = hazy
-    dc = dcp.get_dark_channel(I)
-    A = dcp.get_atmos_light(I, dc)
-    tilde_t = dcp.get_tilde_t(I, A)
-    t = dcp.guided_filter(I, tilde_t, ks=ks, eps=epsilon)
-    
-    filepath = os.path.join(output_root, f"{prefix}_t_{ks[0]}_{epsilon}.png")
-    plt.imsave(filepath, t, **constant.gray_mode)
+    # dc, A and tilde_t are computed once for the whole grid
+    res = sweep.sweep(I, grid, workers=args.workers, outputs=["t"])
+    for params, out in res.points:
+        ks, epsilon = params["ks"], params["eps"]
+        filepath = os.path.join(output_root, f"{prefix}_t_{ks[0]}_{epsilon}.png")
+        plt.imsave(filepath, out.t, **constant.gray_mode)
@@ -3,7 +3,8 @@ sys.path.append("..")
 from dehaze import (
     dcp,
     dataset,
-    constant
+    constant,
+    runner,
 )
 
 import os
@@ -34,8 +35,8 @@ def timer(func):
     return wrapper_timer
 
 
-def main(sots_root, output_dir):
-    data = dataset.TinySOTS(sots_root)
+def main(sots_root, output_dir, workers=None):
+    data = dataset.TinySOTS(sots_root, prefetch=2)
     params = {
         'method': "guided",
         'patch_size': (15,15),
@@ -44,10 +45,18 @@ def main(sots_root, output_dir):
         'ks': (41, 41)
     }
     
+    if workers is not None:
+        stats = runner.run_sots(
+            sots_root, params, output_dir=output_dir, workers=workers,
+            indices=range(len(data))
+        )
+        print(f"{stats.throughput:0.2f} images/s, utilization: {stats.utilization}")
+        return stats
+
     for i in tqdm(range(len(data))):
     # for i in tqdm(range(1)):
         X = data[i]
-        prefix, _ = os.path.splitext(os.path.basename(X.path))
+        prefix = X.name
         
         tic = time.perf_counter()
         res = dcp.dehaze_image(X.hazy, **params)
@@ -88,13 +97,19 @@ if __name__ == '__main__':
         default=r"D:\lab\dataset\IMA201\SOTS\output\task09"
     )
 
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=None
+    )
+
     args = parser.parse_args()
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir, exist_ok=True)
 
     dt = datetime.now().strftime("%Y%m%d-%H%M%S")
 
-    res = main(sots_root=args.input_dir, output_dir=args.output_dir)
+    res = main(sots_root=args.input_dir, output_dir=args.output_dir, workers=args.workers)
 
 
 
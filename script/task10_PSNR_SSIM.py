@@ -4,6 +4,7 @@ sys.path.append("..")
 from dehaze import (
     dcp,
     constant,
+    decoder,
 )
 from dehaze.dataset import TinySOTS
 
@@ -26,12 +27,6 @@ def PSNR(original, compressed):
     psnr = 10 * np.log10(1 / mse) 
     return psnr 
 
-def _imread(path):
-    I = plt.imread(path)
-    if I.dtype == np.uint8:
-        I = I / 255
-    return I
-
 def SSIM(A, B):
     ssim_r = ssim(A[:, :, 0], B[:, :, 0], data_range=1.0)
     ssim_g = ssim(A[:, :, 1], B[:, :, 1], data_range=1.0)
@@ -58,7 +53,7 @@ for prefix in tqdm(data.index):
     gt, hazy, *_ = data.get_by_prefix(prefix=prefix)
     tmp = os.path.join(input_root, prefix)
     J_path = os.path.join(tmp, "J.jpg")
-    J = _imread(J_path)
+    J = decoder.imread_float(J_path)
     gt_hazy_psnr[prefix] = PSNR(gt, hazy)
     gt_J_psnr[prefix] = PSNR(gt, J)
     gt_hazy_ssim[prefix] = SSIM(gt, hazy)
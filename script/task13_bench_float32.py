@@ -0,0 +1,143 @@
+"""
+Compare the float32 pipeline against the float64 one on TinySOTS
+"""
+import sys
+sys.path.append("..")
+from dehaze import (
+    dcp,
+    dataset,
+)
+
+import os
+import numpy as np
+import argparse
+import json
+from datetime import datetime
+from tqdm import tqdm
+import time
+
+
+def main(sots_root, params, repeat=3):
+    data64 = dataset.TinySOTS(sots_root)
+    data32 = dataset.TinySOTS(sots_root, dtype=np.float32)
+
+    res = {}
+    for i in tqdm(range(len(data64))):
+        prefix = data64.index[i]
+        hazy64 = data64[i].hazy
+        hazy32 = data32[i].hazy
+
+        times = {}
+        outputs = {}
+        for name, hazy, dtype in [("float64", hazy64, None), ("float32", hazy32, np.float32)]:
+            best = np.inf
+            for _ in range(repeat):
+                tic = time.perf_counter()
+                outputs[name] = dcp.dehaze_image(hazy, dtype=dtype, **params)
+                best = min(best, time.perf_counter() - tic)
+            times[name] = best
+
+        J64, J32 = outputs["float64"].J, outputs["float32"].J
+        t64, t32 = outputs["float64"].t, outputs["float32"].t
+        res[prefix] = {
+            "time_float64": times["float64"],
+            "time_float32": times["float32"],
+            "dtype_J": str(J32.dtype),
+            "max_abs_diff_J": float(np.max(np.abs(J64 - J32))),
+            "max_abs_diff_t": float(np.max(np.abs(t64 - t32))),
+            "min_t_float32": float(np.min(t32)),
+            "finite_D_float32": bool(np.all(np.isfinite(outputs["float32"].D))),
+        }
+    return res
+
+def check_soft(sots_root, crop=(80, 100)):
+    """
+    soft matting in float32 vs float64 on a crop of every image,
+    full-size soft solves take tens of seconds each
+    """
+    data64 = dataset.TinySOTS(sots_root)
+    data32 = dataset.TinySOTS(sots_root, dtype=np.float32)
+
+    res = {}
+    for i in tqdm(range(len(data64))):
+        prefix = data64.index[i]
+        outputs = {}
+        times = {}
+        for name, data, dtype in [("float64", data64, None), ("float32", data32, np.float32)]:
+            hazy = data[i].hazy[:crop[0], :crop[1]]
+            tic = time.perf_counter()
+            outputs[name] = dcp.dehaze_image(hazy, "soft", dtype=dtype)
+            times[name] = time.perf_counter() - tic
+
+        t64, t32 = outputs["float64"].t, outputs["float32"].t
+        res[prefix] = {
+            "time_float64": times["float64"],
+            "time_float32": times["float32"],
+            "max_abs_diff_t": float(np.max(np.abs(t64 - t32))),
+            "min_t_float32": float(np.min(t32)),
+            "finite_D_float32": bool(np.all(np.isfinite(outputs["float32"].D))),
+        }
+    return res
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--input_dir',
+        type=str,
+        default="../data/tinySOTS"
+    )
+
+    parser.add_argument(
+        '-o', '--output_dir',
+        type=str,
+        default="."
+    )
+
+    parser.add_argument(
+        '-m', '--method',
+        type=str,
+        default="guided"
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=3
+    )
+
+    parser.add_argument(
+        '--soft_crop',
+        type=int,
+        nargs=2,
+        default=[80, 100]
+    )
+
+    args = parser.parse_args()
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    dt = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    params = {
+        'method': args.method,
+        'patch_size': (15,15),
+        'top_ratio': 1e-3,
+    }
+    if args.method in ["guided", "fast"]:
+        params.update({'eps': 1e-3, 'ks': (41, 41)})
+
+    res = main(sots_root=args.input_dir, params=params, repeat=args.repeat)
+
+    t64 = sum(v["time_float64"] for v in res.values()) / len(res)
+    t32 = sum(v["time_float32"] for v in res.values()) / len(res)
+    err = max(v["max_abs_diff_J"] for v in res.values())
+    print(f"float64: {t64:0.4f} s, float32: {t32:0.4f} s, max |J64 - J32|: {err:0.2e}")
+
+    soft = check_soft(sots_root=args.input_dir, crop=args.soft_crop)
+    err = max(v["max_abs_diff_t"] for v in soft.values())
+    min_t = min(v["min_t_float32"] for v in soft.values())
+    finite = all(v["finite_D_float32"] for v in soft.values())
+    print(f"soft on {args.soft_crop} crops: max |t64 - t32|: {err:0.2e}, min t32: {min_t:0.4f}, finite D: {finite}")
+
+    with open(os.path.join(args.output_dir, dt + "_float32.json"), 'w') as f:
+        json.dump({"params": params, "res": res, "soft": soft}, f, indent=4)
@@ -0,0 +1,78 @@
+"""
+Compare soft, guided and fast on SOTS in one pass: each image is decoded once
+and dc, A, tilde_t are shared between the methods
+"""
+import sys
+sys.path.append("..")
+from dehaze import (
+    runner,
+)
+
+import os
+import argparse
+import json
+from datetime import datetime
+
+
+METHODS = {
+    "soft": {'lam': 1e-4},
+    "guided": {'eps': 1e-3, 'ks': (41, 41)},
+    "fast": {'eps': 1e-3, 'ks': (41, 41), 's': 4},
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--input_dir',
+        type=str,
+        default=r"D:\lab\dataset\IMA201\SOTS\outdoor"
+    )
+
+    parser.add_argument(
+        '-o', '--output_dir',
+        type=str,
+        default=r"D:\lab\dataset\IMA201\SOTS\output\task14"
+    )
+
+    parser.add_argument(
+        '-m', '--methods',
+        type=str,
+        nargs='+',
+        default=list(METHODS)
+    )
+
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=None
+    )
+
+    args = parser.parse_args()
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    dt = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    params = {
+        'patch_size': (15,15),
+        'top_ratio': 1e-3,
+    }
+    methods = {m: METHODS[m] for m in args.methods}
+
+    stats = runner.run_sots(
+        args.input_dir, params, output_dir=args.output_dir,
+        workers=args.workers, methods=methods
+    )
+
+    n = len(stats.results)
+    summary = {"shared": sum(r["time"]["shared"] for r in stats.results) / n}
+    for m in methods:
+        summary[m] = {
+            "time": sum(r["time"][m] for r in stats.results) / n,
+            "psnr": sum(r[m]["psnr"] for r in stats.results) / n,
+        }
+        print(f"{m}: {summary[m]['time']:0.4f} s, PSNR {summary[m]['psnr']:0.2f}")
+    print(f"shared: {summary['shared']:0.4f} s, {stats.throughput:0.2f} images/s")
+
+    with open(os.path.join(args.output_dir, dt + "_compare.json"), 'w') as f:
+        json.dump({"params": params, "methods": methods, "summary": summary, "res": stats.results}, f, indent=4)
@@ -0,0 +1,51 @@
+"""
+Pack a TinySOTS folder into one memory-mapped file and compare the read time
+(decoding every image vs viewing the packed planes)
+"""
+import sys
+sys.path.append("..")
+from dehaze import (
+    dataset,
+)
+
+import os
+import argparse
+import time
+
+
+def read_all(data):
+    tic = time.perf_counter()
+    for i in range(len(data)):
+        X = data[i]
+    return time.perf_counter() - tic
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '-i', '--input_dir',
+        type=str,
+        default="../data/tinySOTS"
+    )
+
+    parser.add_argument(
+        '-o', '--output_path',
+        type=str,
+        default="./tinySOTS.pack"
+    )
+
+    args = parser.parse_args()
+    out_dir = os.path.dirname(os.path.abspath(args.output_path))
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir, exist_ok=True)
+
+    tic = time.perf_counter()
+    n = dataset.pack_sots(args.input_dir, args.output_path)
+    toc = time.perf_counter()
+    size = os.path.getsize(args.output_path)
+    print(f"packed {n} samples into {args.output_path} ({size / 2**20:0.1f} MiB) in {toc - tic:0.2f} s")
+
+    t_dir = read_all(dataset.TinySOTS(args.input_dir))
+    t_float = read_all(dataset.PackedSOTS(args.output_path))
+    t_raw = read_all(dataset.PackedSOTS(args.output_path, raw=True))
+    print(f"TinySOTS: {t_dir:0.4f} s, PackedSOTS: {t_float:0.4f} s, PackedSOTS(raw): {t_raw:0.4f} s")